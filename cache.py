@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+import tempfile
+from hashlib import sha1
+from typing import Any, Optional
+
+logger = logging.getLogger('app')
+
+CURRENT_PATH = os.path.dirname(os.path.realpath(__file__))
+CACHE_PATH = os.path.join(CURRENT_PATH, 'cache')
+
+
+def get_cache_file(name: str) -> str:
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    return os.path.join(CACHE_PATH, name)
+
+
+def get_cache_key(value: str) -> str:
+    return sha1(value.encode()).hexdigest()
+
+
+def write_file_atomic(path: str, data: bytes):
+    # Write to a temp file and swap it in so a power cut mid-write
+    # never leaves a truncated cache file behind.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def read_bytes(name: str) -> Optional[bytes]:
+    path = get_cache_file(name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as cache_file:
+        return cache_file.read()
+
+
+def write_bytes(name: str, data: bytes):
+    write_file_atomic(get_cache_file(name), data)
+
+
+def read_json(name: str) -> Optional[Any]:
+    data = read_bytes(name)
+    if data is None:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        logger.warning("Ignoring corrupt cache file %s", name)
+        return None
+
+
+def write_json(name: str, data: Any):
+    write_bytes(name, json.dumps(data).encode())
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field, fields
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from icalevents.icalparser import Event
+
+import settings
+from cache import get_cache_file, write_file_atomic
+from dataHelper import authorize_google_contacts, get_birthdays, get_cached_birthdays, get_events, get_stored_events
+from holidays import get_todays_holiday
+from weather import Weather, get_cached_weather, get_weather, get_weather_icon
+
+logger = logging.getLogger('app')
+
+REFRESH_DEADLINE = 45
+SNAPSHOT_NAME = "snapshot.json"
+
+
+@dataclass
+class DisplayData:
+    now: datetime = field(default_factory=datetime.now)
+    events: List[Event] = field(default_factory=list)
+    weather: Optional[Weather] = None
+    birthdays: List[str] = field(default_factory=list)
+    upcoming_birthdays: List[str] = field(default_factory=list)
+    holiday: Optional[str] = None
+
+
+def get_sources(max_events: int) -> Dict[str, Tuple[Callable[[], Any], Callable[[], Any]]]:
+    # Each source has a fetch and an offline fallback that only reads what
+    # earlier runs left in the cache.
+    force_birthdays = bool(os.environ.get("REFRESH_BIRTHDAYS"))
+    return {
+        "events": (lambda: get_events(max_events), lambda: get_stored_events(max_events)),
+        "weather": (get_weather, get_cached_weather),
+        "birthdays": (lambda: get_birthdays(force_refresh=force_birthdays), get_cached_birthdays),
+        "holiday": (get_todays_holiday, lambda: get_todays_holiday(fetch=False)),
+    }
+
+
+def fetch_display_data(max_events: int) -> DisplayData:
+    """Fetch every data source concurrently, giving up on them after REFRESH_DEADLINE seconds.
+
+    Sources that fail or miss the deadline are filled in from the cache, so
+    the panel update never waits longer than the deadline.
+    """
+    # First-time Google authorization waits for the user in a browser, which
+    # the deadline below would cut short.
+    try:
+        authorize_google_contacts()
+    except Exception:
+        logger.exception("Failed to authorize Google contacts")
+
+    sources = get_sources(max_events)
+    results: Dict[str, Any] = {}
+    lock = threading.Lock()
+
+    def fetch(name: str, fetch_source: Callable[[], Any]):
+        start = time.monotonic()
+        try:
+            result = fetch_source()
+        except Exception:
+            logger.exception("Failed to fetch %s", name)
+            return
+        with lock:
+            results[name] = result
+        logger.info("Fetched %s in %.2fs", name, time.monotonic() - start)
+
+    # Daemon threads, as are the calendar syncs they start, so a source that is
+    # still hanging does not keep the process alive.
+    threads = [
+        threading.Thread(target=fetch, args=(name, fetch_source), name=f"fetch-{name}", daemon=True)
+        for name, (fetch_source, _) in sources.items()
+    ]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + getattr(settings, "REFRESH_DEADLINE", REFRESH_DEADLINE)
+    for thread in threads:
+        thread.join(timeout=max(0, deadline - time.monotonic()))
+
+    with lock:
+        fetched = dict(results)
+    for name, (_, fallback) in sources.items():
+        if name not in fetched:
+            logger.warning("Using cached %s", name)
+            try:
+                fetched[name] = fallback()
+            except Exception:
+                logger.exception("No cached %s", name)
+                fetched[name] = None
+
+    birthdays, upcoming_birthdays = fetched["birthdays"] or ([], [])
+    data = DisplayData(
+        events=fetched["events"] or [],
+        weather=fetched["weather"],
+        birthdays=birthdays,
+        upcoming_birthdays=upcoming_birthdays,
+        holiday=fetched["holiday"],
+    )
+    save_snapshot(data, get_cache_file(SNAPSHOT_NAME))
+    return data
+
+
+def event_to_dict(event: Event) -> dict:
+    return {
+        "uid": event.uid,
+        "summary": event.summary,
+        "description": event.description,
+        "location": event.location,
+        "start": event.start.isoformat(),
+        "end": event.end.isoformat(),
+        "all_day": event.all_day,
+    }
+
+
+def event_from_dict(event_dict: dict) -> Event:
+    event = Event()
+    event.uid = event_dict["uid"]
+    event.summary = event_dict["summary"]
+    event.description = event_dict["description"]
+    event.location = event_dict["location"]
+    event.start = datetime.fromisoformat(event_dict["start"])
+    event.end = datetime.fromisoformat(event_dict["end"])
+    event.all_day = event_dict["all_day"]
+    return event
+
+
+def save_snapshot(data: DisplayData, path: str):
+    """Write everything the renderer needs to a JSON file, so a frame can be rendered again offline."""
+    weather = None
+    if data.weather:
+        # The icon image is rebuilt from its code on load.
+        weather = {f.name: getattr(data.weather, f.name) for f in fields(Weather) if f.name != "weather_icon"}
+    snapshot = {
+        "now": data.now.isoformat(),
+        "events": [event_to_dict(event) for event in data.events],
+        "weather": weather,
+        "birthdays": data.birthdays,
+        "upcoming_birthdays": data.upcoming_birthdays,
+        "holiday": data.holiday,
+    }
+    write_file_atomic(os.path.abspath(path), json.dumps(snapshot, indent=2).encode())
+    logger.info("Saved data snapshot to %s", path)
+
+
+def load_snapshot(path: str) -> DisplayData:
+    with open(path) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    weather = None
+    if snapshot["weather"]:
+        weather = Weather(**snapshot["weather"], weather_icon=get_weather_icon(snapshot["weather"]["icon"]))
+    return DisplayData(
+        now=datetime.fromisoformat(snapshot["now"]),
+        events=[event_from_dict(event) for event in snapshot["events"]],
+        weather=weather,
+        birthdays=snapshot["birthdays"],
+        upcoming_birthdays=snapshot["upcoming_birthdays"],
+        holiday=snapshot["holiday"],
+    )
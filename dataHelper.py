@@ -1,28 +1,49 @@
+import calendar
+import json
 import logging
 import os.path
-from datetime import date, datetime, timedelta, timezone
-from typing import List, Tuple
-from urllib.parse import urlparse
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
 from zoneinfo import ZoneInfo
 
-import requests
 import vobject
-from google.auth.exceptions import RefreshError
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from humanize import ordinal
-from icalevents.icalevents import events
+from icalevents.icaldownload import apple_data_fix, apple_url_fix
 from icalevents.icalparser import Event
 from lxml import etree
 from requests.auth import HTTPBasicAuth
 
+import eventStore
+import httpClient
 import settings
+from cache import get_cache_key, read_bytes, read_json, write_bytes, write_file_atomic, write_json
 
 logger = logging.getLogger('app')
 
 UPCOMING_BIRTHDAY_DAYS = 8
+CALENDAR_TIMEOUT = 30
+CALENDAR_DEADLINE = 60
+MAX_CALENDAR_WORKERS = 8
+CALENDAR_LOOKAHEAD_DAYS = [1, 7, 30, 90]
+SINGLE_EVENT_HORIZON_DAYS = 3650
+BIRTHDAY_INDEX_NAME = "birthdays.json"
+CARDDAV_TIMEOUT = 30
+CARDDAV_MULTIGET_BATCH = 100
+CARDDAV_STORE_NAME = "carddav.json"
+GOOGLE_CONTACTS_STORE_NAME = "google_contacts.json"
+GOOGLE_CONNECTIONS_PAGE_SIZE = 1000
+GOOGLE_TOKEN_FILE = "token.json"
+GOOGLE_SCOPES = ["https://www.googleapis.com/auth/contacts.readonly"]
+CARDDAV_NAMESPACE = "urn:ietf:params:xml:ns:carddav"
+DAV_NAMESPACES = {"d": "DAV:", "card": CARDDAV_NAMESPACE}
+PROPFIND_BODY = b"""<?xml version="1.0" encoding="utf-8"?>
+<d:propfind xmlns:d="DAV:"><d:prop><d:getcontenttype/><d:getetag/></d:prop></d:propfind>"""
 
 
 def sort_by_date(e: Event):
@@ -31,167 +52,488 @@ def sort_by_date(e: Event):
 
 def get_events(max_number: int) -> List[Event]:
     logger.info("Retrieving calendar infos")
-    cal_events = []
-    for calendar_url in settings.CALENDAR_URLS:
-        cal_events.extend(get_webdav_events(calendar_url, max_number))
-    cal_events.sort(key=sort_by_date)
-    return cal_events[:max_number]
-
-
-def get_webdav_events(url: str, max_number: int) -> List[Event]:
+    if not settings.CALENDAR_URLS:
+        return []
+    # Feeds are synced side by side so a run costs about as much as the slowest one.
+    workers = min(len(settings.CALENDAR_URLS), MAX_CALENDAR_WORKERS)
+    deadline = time.monotonic() + CALENDAR_DEADLINE
+    pending = queue.SimpleQueue()
+    for url in settings.CALENDAR_URLS:
+        pending.put(url)
+    finished = set()
+    lock = threading.Lock()
+
+    def sync_pending():
+        # Feeds not started by the deadline are left alone.
+        while time.monotonic() < deadline:
+            try:
+                calendar_url = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                sync_calendar(calendar_url, max_number)
+            except Exception as e:
+                logger.critical(e)
+            with lock:
+                finished.add(calendar_url)
+
+    # Daemon threads rather than an executor, whose workers are joined at
+    # exit, so a feed that is still hanging does not keep the process alive.
+    threads = [
+        threading.Thread(target=sync_pending, name=f"calendar-{i}", daemon=True) for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=max(0, deadline - time.monotonic()))
+    with lock:
+        for calendar_url in settings.CALENDAR_URLS:
+            if calendar_url not in finished:
+                logger.error("Timed out retrieving calendar %s", calendar_url)
+
+    # Whatever did not sync in time is served from the last successful sync.
+    return get_stored_events(max_number)
+
+
+def get_stored_events(max_number: int) -> List[Event]:
+    current_timezone = ZoneInfo(settings.LOCAL_TIMEZONE)
+    with closing(eventStore.connect()) as conn:
+        cal_events = eventStore.query_events(
+            conn, settings.CALENDAR_URLS, datetime.now(current_timezone), max_number, current_timezone
+        )
+    logger.info("Got %s calendar-entries", len(cal_events))
+    return cal_events
+
+
+def download_calendar(url: str, fix_apple: bool = False) -> bytes:
+    """Download an ICS feed, reusing the cached copy if the server reports it unchanged.
+
+    The body is stored alongside its ETag/Last-Modified so the next run can send a
+    conditional request. Within CALENDAR_CACHE_MAX_AGE seconds of the last download
+    the cached body is used without contacting the server at all.
+    """
+    cache_key = get_cache_key(url)
+    body_name = f"calendar-{cache_key}.ics"
+    meta_name = f"calendar-{cache_key}.json"
+    meta = read_json(meta_name) or {}
+    body = read_bytes(body_name)
+
+    max_age = getattr(settings, "CALENDAR_CACHE_MAX_AGE", 0)
+    if body is not None and time.time() - meta.get("fetched", 0) < max_age:
+        logger.info("Using cached calendar %s", url)
+        return body
+
+    headers = {}
+    if body is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    request_url = apple_url_fix(url) if fix_apple else url
+    response = httpClient.get(request_url, headers=headers, timeout=CALENDAR_TIMEOUT)
+    if response.status_code == 304 and body is not None:
+        logger.info("Calendar %s not modified", url)
+    else:
+        response.raise_for_status()
+        body = response.content
+        write_bytes(body_name, body)
+    write_json(meta_name, {
+        "etag": response.headers.get("ETag", meta.get("etag")),
+        "last_modified": response.headers.get("Last-Modified", meta.get("last_modified")),
+        "fetched": time.time(),
+    })
+    return body
+
+
+def expand_lookahead(conn: sqlite3.Connection, url: str, max_number: int, calendar_start: datetime,
+                     current_timezone: ZoneInfo):
+    # Recurring events are only expanded as far ahead as needed: the window
+    # grows until it holds enough upcoming events or runs out of steps.
+    recurring_uids = eventStore.get_uids(conn, url, recurring=True)
+    lookahead_days = getattr(settings, "CALENDAR_LOOKAHEAD_DAYS", CALENDAR_LOOKAHEAD_DAYS)
+    for days in lookahead_days:
+        calendar_end = calendar_start + timedelta(days=days)
+        eventStore.expand_events(conn, url, recurring_uids, calendar_start, calendar_end, current_timezone)
+        eventStore.set_expanded(conn, url, calendar_start.date().isoformat(), calendar_end.timestamp())
+        if eventStore.count_events(conn, url, calendar_start) >= max_number:
+            break
+    logger.info("Expanded %s recurring events of %s within %s days", len(recurring_uids), url, days)
+
+
+def sync_calendar(url: str, max_number: int):
     logger.info("Retrieving calendar %s", url)
     current_timezone = ZoneInfo(settings.LOCAL_TIMEZONE)
     calendar_start = datetime.now(current_timezone)
-    today_midnight = datetime.now(current_timezone).replace(hour=0, minute=0, second=0, microsecond=0)
     is_apple = "icloud" in url
-    try:
-        event_list = events(url, start=calendar_start, fix_apple=is_apple)
-        event_list.sort(key=sort_by_date)
-
-        start_count = 0
-        for event in event_list:
-            if event.start.tzinfo is None or event.start.tzinfo.utcoffset(event.start) is None:
-                event.start = event.start.replace(tzinfo=timezone.utc)
-            if event.all_day:
-                event.start = event.start.replace(tzinfo=current_timezone)
-                event.end = event.end.replace(tzinfo=current_timezone)
-            event.start = event.start.astimezone(current_timezone)
-            event.end = event.end.astimezone(current_timezone)
-
-            # Multi-day events end at midnight of the previous/current
-            # day and thus show up after they're over.
-            if event.end == today_midnight:
-                start_count += 1
-                max_number += 1
-        logger.info(
-            "Got %s calendar-entries (capped to %s)",
-            len(event_list) - start_count,
-            max_number - start_count
+    content = download_calendar(url, fix_apple=is_apple)
+    if is_apple:
+        content = apple_data_fix(content.decode("utf-8")).encode("utf-8")
+
+    with closing(eventStore.connect()) as conn:
+        changed = eventStore.update_components(conn, url, content)
+        changed_uids = changed or set()
+        calendar_state = eventStore.get_calendar(conn, url)
+
+        # Single events are stored once whatever the lookahead; only recurring
+        # ones depend on the window and are re-expanded each new day.
+        recurring_uids = eventStore.get_uids(conn, url, recurring=True)
+        eventStore.expand_events(
+            conn, url, changed_uids - recurring_uids,
+            calendar_start, calendar_start + timedelta(days=SINGLE_EVENT_HORIZON_DAYS), current_timezone
         )
-        return event_list[start_count:max_number]
-
-    except Exception as e:
-        logger.critical(e)
-        return []
+        expanded_today = calendar_state["expanded_on"] == calendar_start.date().isoformat()
+        if expanded_today and changed_uids & recurring_uids:
+            calendar_end = datetime.fromtimestamp(calendar_state["expanded_until"], current_timezone)
+            eventStore.expand_events(
+                conn, url, changed_uids & recurring_uids, calendar_start, calendar_end, current_timezone
+            )
+        # The window was laid out from an earlier run, so by now occurrences may
+        # have passed; grow it again whenever it no longer holds enough of them.
+        if not expanded_today or eventStore.count_events(conn, url, calendar_start) < max_number:
+            expand_lookahead(conn, url, max_number, calendar_start, current_timezone)
+        if changed is not None:
+            # Only now is the feed body done with; a sync cut short before this
+            # point parses and expands the whole feed again next time.
+            eventStore.set_body_hash(conn, url, eventStore.get_body_hash(content))
+
+
+def get_vcard_birthday(vcard_text: str) -> Optional[Tuple[str, int, int]]:
+    vcard = vobject.readOne(vcard_text)
+    if 'bday' not in vcard.contents.keys():
+        return None
+    birthday = vcard.contents['bday'][0]
+    try:
+        birthday_date = datetime.strptime(
+            birthday.value, "%Y-%m-%d")
+    except ValueError:
+        # necessary, because multipe formats are used...
+        birthday_date = datetime.strptime(birthday.value, "%Y%m%d")
+
+    name = vcard.contents['fn'][0].value
+    return name, birthday_date.month, birthday_date.day
+
+
+def get_caldav_auth() -> HTTPBasicAuth:
+    return HTTPBasicAuth(settings.CALDAV_CONTACT_USER, settings.CALDAV_CONTACT_PWD)
+
+
+def get_vcard_hrefs() -> List[str]:
+    resp = httpClient.request(
+        'PROPFIND', settings.CALDAV_CONTACT_URL, data=PROPFIND_BODY,
+        headers={'Depth': '1', 'Content-Type': 'application/xml; charset=utf-8'},
+        auth=get_caldav_auth(), timeout=CARDDAV_TIMEOUT
+    )
+
+    if resp.status_code != 207:
+        raise RuntimeError('error in response from %s: %r' %
+                           (settings.CALDAV_CONTACT_URL, resp))
+
+    root = etree.XML(resp.content)
+    return [
+        link.text for link in
+        root.xpath('./d:response/d:propstat/d:prop/d:getcontenttype[starts-with(.,"text/vcard")]/../../../d:href', namespaces=DAV_NAMESPACES)
+    ]
+
+
+def sync_collection(sync_token: str) -> Optional[Tuple[str, List[str], List[str]]]:
+    """Ask for the cards changed since sync_token (RFC 6578).
+
+    Returns the new sync-token with the changed and deleted hrefs, or None if
+    the server rejects the token or does not support sync-collection.
+    """
+    sync = etree.Element(etree.QName("DAV:", "sync-collection"), nsmap={"d": "DAV:"})
+    etree.SubElement(sync, etree.QName("DAV:", "sync-token")).text = sync_token
+    etree.SubElement(sync, etree.QName("DAV:", "sync-level")).text = "1"
+    prop = etree.SubElement(sync, etree.QName("DAV:", "prop"))
+    etree.SubElement(prop, etree.QName("DAV:", "getetag"))
+
+    resp = httpClient.request(
+        'REPORT', settings.CALDAV_CONTACT_URL, data=etree.tostring(sync, xml_declaration=True, encoding="utf-8"),
+        headers={'Content-Type': 'application/xml; charset=utf-8'},
+        auth=get_caldav_auth(), timeout=CARDDAV_TIMEOUT
+    )
+    if resp.status_code != 207:
+        logger.info("sync-collection not available (%s)", resp.status_code)
+        return None
+
+    root = etree.XML(resp.content)
+    collection_path = urlparse(settings.CALDAV_CONTACT_URL).path.rstrip("/")
+    changed, deleted = [], []
+    for response in root.xpath('./d:response', namespaces=DAV_NAMESPACES):
+        href = response.findtext('d:href', namespaces=DAV_NAMESPACES)
+        if not href or href.rstrip("/") == collection_path:
+            continue
+        if " 404 " in (response.findtext('d:status', namespaces=DAV_NAMESPACES) or ""):
+            deleted.append(href)
+        else:
+            changed.append(href)
+    return root.findtext('d:sync-token', namespaces=DAV_NAMESPACES), changed, deleted
 
 
-def get_birthdays_caldav() -> Tuple[List[str], List[str]]:
+def get_birthdays_caldav() -> List[Tuple[str, int, int]]:
     logger.info("Retrieving contact (birthday) infos")
+    # Cards are kept locally with the last sync-token, so a steady-state run
+    # only transfers the cards that changed since then.
+    store = read_json(CARDDAV_STORE_NAME) or {}
+    if store.get("url") != settings.CALDAV_CONTACT_URL:
+        store = {}
+    cards: Dict[str, Optional[List]] = store.get("cards", {})
+    sync_token = store.get("sync_token")
+
+    result = sync_collection(sync_token) if sync_token else None
+    if result is None:
+        # Unknown or expired token: start over from an empty one.
+        cards = {}
+        result = sync_collection("")
+    if result is None:
+        sync_token, changed, deleted = None, get_vcard_hrefs(), []
+    else:
+        sync_token, changed, deleted = result
+
+    for href in deleted:
+        cards.pop(href, None)
+    # Cards are fetched in batches with addressbook-multiget instead of one GET each.
+    for i in range(0, len(changed), CARDDAV_MULTIGET_BATCH):
+        batch = changed[i:i + CARDDAV_MULTIGET_BATCH]
+        vcards = get_vcards_multiget(batch)
+        for href in batch:
+            vcard_text = vcards.get(unquote(href))
+            birthday = get_vcard_birthday(vcard_text) if vcard_text else None
+            cards[href] = list(birthday) if birthday else None
+    logger.info("Synced vCards: %s changed, %s deleted, %s total", len(changed), len(deleted), len(cards))
+
+    write_json(CARDDAV_STORE_NAME, {"url": settings.CALDAV_CONTACT_URL, "sync_token": sync_token, "cards": cards})
+    return [tuple(birthday) for birthday in cards.values() if birthday]
+
+
+def get_vcards_multiget(hrefs: List[str]) -> Dict[str, str]:
+    multiget = etree.Element(etree.QName(CARDDAV_NAMESPACE, "addressbook-multiget"), nsmap=DAV_NAMESPACES)
+    prop = etree.SubElement(multiget, etree.QName("DAV:", "prop"))
+    etree.SubElement(prop, etree.QName("DAV:", "getetag"))
+    etree.SubElement(prop, etree.QName(CARDDAV_NAMESPACE, "address-data"))
+    for href in hrefs:
+        etree.SubElement(multiget, etree.QName("DAV:", "href")).text = href
+
+    resp = httpClient.request(
+        'REPORT', settings.CALDAV_CONTACT_URL, data=etree.tostring(multiget, xml_declaration=True, encoding="utf-8"),
+        # No Depth header: RFC 6352 asks clients not to send one with a multiget.
+        headers={'Content-Type': 'application/xml; charset=utf-8'},
+        auth=get_caldav_auth(), timeout=CARDDAV_TIMEOUT
+    )
+    if resp.status_code != 207:
+        raise RuntimeError('error in response from %s: %r' %
+                           (settings.CALDAV_CONTACT_URL, resp))
+
+    vcards: Dict[str, str] = {}
+    for response in etree.XML(resp.content).xpath('./d:response', namespaces=DAV_NAMESPACES):
+        href = response.findtext('d:href', namespaces=DAV_NAMESPACES)
+        address_data = response.findtext('d:propstat/d:prop/card:address-data', namespaces=DAV_NAMESPACES)
+        if href and address_data:
+            vcards[unquote(href)] = address_data
+    return vcards
+
+
+def save_google_credentials(creds):
+    write_file_atomic(os.path.abspath(GOOGLE_TOKEN_FILE), creds.to_json().encode())
+
+
+def has_google_refresh_token() -> bool:
+    # Read as plain JSON, so runs that are already authorised do not pay for importing google-auth.
     try:
-        session = requests.Session()
-        session.auth = HTTPBasicAuth(settings.CALDAV_CONTACT_USER, settings.CALDAV_CONTACT_PWD)
-        baseurl = urlparse(settings.CALDAV_CONTACT_URL).scheme + \
-            '://' + urlparse(settings.CALDAV_CONTACT_URL).netloc
-
-        resp = requests.request('PROPFIND', settings.CALDAV_CONTACT_URL, headers={'Depth': '1'})
-
-        if resp.status_code != 207:
-            raise RuntimeError('error in response from %s: %r' %
-                               (settings.CALDAV_CONTACT_URL, r))
-
-        vcardUrlList = []
-        root = etree.XML(resp.text.encode())
-        for link in root.xpath('./d:response/d:propstat/d:prop/d:getcontenttype[starts-with(.,"text/vcard")]/../../../d:href', namespaces={"d": "DAV:"}):
-            vcardUrlList.append(baseurl + link.text)
-
-        today = datetime.today()
-        birthday_names: List[str] = []
-        for vurl in vcardUrlList:
-            r = requests.request("GET", vurl, auth=auth)
-            vcard = vobject.readOne(r.text)
-            if 'bday' in vcard.contents.keys():
-                birthday = vcard.contents['bday'][0]
-                try:
-                    birthday_date = datetime.strptime(
-                        birthday.value, "%Y-%m-%d")
-                except ValueError:
-                    # necessary, because multipe formats are used...
-                    birthday_date = datetime.strptime(birthday.value, "%Y%m%d")
-
-                if (birthday_date.day == today.day) and (birthday_date.month == today.month):
-                    name = vcard.contents['fn'][0].value
-                    birthday_names.append(name)
-        return birthday_names, []
-    except Exception as e:
-        logger.critical(e)
-        return [], []
+        with open(GOOGLE_TOKEN_FILE) as token_file:
+            return bool(json.load(token_file).get("refresh_token"))
+    except (OSError, ValueError):
+        return False
 
 
-def get_birthday_date_from_google_person(person: dict) -> date:
-    if person.get("birthdays") and person.get("birthdays")[0].get("date"):
-        birthday = person.get("birthdays")[0].get("date")
-        today = date.today()
-        month = birthday.get("month")
-        day = birthday.get("day")
-        if month == 2 and day == 29 and today.year % 4 != 0:  # Will be inaccurate in year 2100 ;p
-            day = 28
+def authorize_google_contacts():
+    """Let the user log in to Google if there is no token to refresh yet.
 
-        return date(year=today.year, month=month, day=day)
-    return None
+    The browser flow waits for the user, so it runs before the data sources
+    are fetched under their deadline rather than from the birthday refresh.
+    """
+    if not settings.GOOGLE_CONTACTS_GROUP or has_google_refresh_token():
+        return
+    from google_auth_oauthlib.flow import InstalledAppFlow
 
+    logger.info("No Google credentials yet, starting the authorization flow")
+    flow = InstalledAppFlow.from_client_secrets_file("credentials.json", GOOGLE_SCOPES)
+    save_google_credentials(flow.run_local_server(port=0))
 
-def get_birthdays_google() -> Tuple[List[str], List[str]]:
-    scopes = ["https://www.googleapis.com/auth/contacts.readonly"]
-    logger.info("Retrieving contact (birthday) infos")
-    today = datetime.today()
-    birthday_names: List[str] = []
-    upcoming_birthday_names: List[str] = []
+
+def get_google_credentials():
+    from google.auth.exceptions import RefreshError
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
 
     creds = None
     try:
-        if os.path.exists("token.json"):
+        if os.path.exists(GOOGLE_TOKEN_FILE):
             # The file token.json stores the user's access and refresh tokens, and is
             # created automatically when the authorization flow completes for the first time.
-            creds = Credentials.from_authorized_user_file("token.json", scopes)
-            if creds and creds.refresh_token:
-                logger.info("Refreshing credentials")
-                creds.refresh(Request())
-        if not creds or not creds.valid:
-            # If there are no (valid) credentials available, let the user log in.
-            if creds and creds.expired and creds.refresh_token:
-                logger.info("Refreshing credentials on expired")
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file("credentials.json", scopes)
-                creds = flow.run_local_server(port=0)
-                # Save the credentials for the next run
-                with open("token.json", "w") as token:
-                    token.write(creds.to_json())
+            creds = Credentials.from_authorized_user_file(GOOGLE_TOKEN_FILE, GOOGLE_SCOPES)
+        if creds and creds.valid:
+            # Still valid (google-auth treats it as expired shortly before it actually is).
+            return creds
+        if not (creds and creds.expired and creds.refresh_token):
+            raise RuntimeError(
+                f"No usable Google credentials in {GOOGLE_TOKEN_FILE}: run displayRun.py once from a terminal "
+                "to authorize access to the contacts"
+            )
+        logger.info("Refreshing credentials on expired")
+        creds.refresh(Request(session=httpClient.get_session()))
+        # Save the credentials for the next run
+        save_google_credentials(creds)
     except RefreshError:
         logger.warning("Failed to refresh credentials")
+    return creds
 
-    try:
-        service = build("people", "v1", credentials=creds)
 
-        group = service.contactGroups().get(
-            resourceName=f"contactGroups/{settings.GOOGLE_CONTACTS_GROUP}",
-            maxMembers=100
-        ).execute()
+def get_birthday_from_google_person(person: dict) -> Optional[Tuple[str, int, int]]:
+    if not person.get("names") or not person.get("names")[0].get("displayName"):
+        return None
+    if person.get("birthdays") and person.get("birthdays")[0].get("date"):
+        birthday = person.get("birthdays")[0].get("date")
+        if birthday.get("month") and birthday.get("day"):
+            return person.get("names")[0].get("displayName"), birthday.get("month"), birthday.get("day")
+    return None
+
 
-        results = service.people().getBatchGet(
-            resourceNames=group.get("memberResourceNames"),
-            personFields="names,birthdays",
-        ).execute()
-    except Exception as e:
-        logger.critical(e)
-        return [], ["Broken Credentials"]
+def list_google_connections(service, sync_token: Optional[str]) -> Tuple[str, List[dict]]:
+    request_args = {
+        "resourceName": "people/me",
+        "personFields": "names,birthdays,memberships",
+        "pageSize": GOOGLE_CONNECTIONS_PAGE_SIZE,
+        "requestSyncToken": True,
+    }
+    if sync_token:
+        request_args["syncToken"] = sync_token
 
-    today = date.today()
-    for result in results.get("responses"):
-        person = result.get("person")
-        if not person.get("names") or not person.get("names")[0].get("displayName"):
-            continue
-        name = person.get("names")[0].get("displayName")
-        birthday = get_birthday_date_from_google_person(person)
-        if birthday and birthday.day == today.day and birthday.month == today.month and person.get("names"):
-            birthday_names.append(person.get("names")[0].get("displayName"))
-        elif birthday and birthday > today and birthday < (today + timedelta(days=UPCOMING_BIRTHDAY_DAYS)) and person.get("names"):
-            upcoming_birthday_names.append(f"{name} ({ordinal(birthday.day)})")
-    return birthday_names, upcoming_birthday_names
+    connections: List[dict] = []
+    page_token = None
+    while True:
+        response = service.people().connections().list(pageToken=page_token, **request_args).execute()
+        connections.extend(response.get("connections", []))
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return response.get("nextSyncToken"), connections
+
+
+def is_in_google_group(person: dict, group_name: str) -> bool:
+    return any(
+        membership.get("contactGroupMembership", {}).get("contactGroupResourceName") == group_name
+        for membership in person.get("memberships", [])
+    )
 
 
-def get_birthdays() -> Tuple[List[str], List[str]]:
+def get_birthdays_google() -> List[Tuple[str, int, int]]:
+    # The Google client libraries take seconds to import on a Pi Zero and
+    # this only runs once a day, so they are imported here rather than on every run.
+    from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
+
+    logger.info("Retrieving contact (birthday) infos")
+    # The discovery document bundled with the client is used instead of downloading it.
+    service = build("people", "v1", credentials=get_google_credentials(), static_discovery=True, cache_discovery=False)
+
+    # Group members are kept locally with the last sync token, so a
+    # steady-state run only receives the contacts that changed since then.
+    store = read_json(GOOGLE_CONTACTS_STORE_NAME) or {}
+    if store.get("group") != settings.GOOGLE_CONTACTS_GROUP:
+        store = {}
+    people: Dict[str, Optional[List]] = store.get("people", {})
+    sync_token = store.get("sync_token")
+
+    try:
+        sync_token, connections = list_google_connections(service, sync_token)
+    except HttpError as e:
+        # Sync tokens expire about 7 days after they are issued, used or not.
+        # The API answers 400 FAILED_PRECONDITION (EXPIRED_SYNC_TOKEN) then;
+        # any error on an incremental sync is taken as a reason to start over.
+        if not sync_token:
+            raise
+        logger.info("Google contacts sync token rejected (%s), syncing everything", e.resp.status)
+        people = {}
+        sync_token, connections = list_google_connections(service, None)
+
+    group_name = f"contactGroups/{settings.GOOGLE_CONTACTS_GROUP}"
+    for person in connections:
+        resource_name = person.get("resourceName")
+        if person.get("metadata", {}).get("deleted") or not is_in_google_group(person, group_name):
+            people.pop(resource_name, None)
+        else:
+            birthday = get_birthday_from_google_person(person)
+            people[resource_name] = list(birthday) if birthday else None
+    logger.info("Synced Google contacts: %s changed, %s in group", len(connections), len(people))
+
+    write_json(GOOGLE_CONTACTS_STORE_NAME, {
+        "group": settings.GOOGLE_CONTACTS_GROUP,
+        "sync_token": sync_token,
+        "people": people,
+    })
+    return [tuple(birthday) for birthday in people.values() if birthday]
+
+
+def get_birthday_key(month: int, day: int) -> str:
+    return f"{month:02d}-{day:02d}"
+
+
+def refresh_birthday_index() -> Optional[Dict[str, List[str]]]:
     if settings.GOOGLE_CONTACTS_GROUP:
-        return get_birthdays_google()
+        birthdays = get_birthdays_google()
     elif settings.CALDAV_CONTACT_USER and settings.CALDAV_CONTACT_PWD:
-        return get_birthdays_caldav()
+        birthdays = get_birthdays_caldav()
+    else:
+        return None
+
+    index: Dict[str, List[str]] = {}
+    for name, month, day in birthdays:
+        index.setdefault(get_birthday_key(month, day), []).append(name)
+    write_json(BIRTHDAY_INDEX_NAME, {"refreshed": date.today().isoformat(), "birthdays": index})
+    logger.info("Indexed %s birthdays", len(birthdays))
+    return index
+
+
+def get_birthday_names(index: Dict[str, List[str]], day: date) -> List[str]:
+    names = list(index.get(get_birthday_key(day.month, day.day), []))
+    if day.month == 2 and day.day == 28 and not calendar.isleap(day.year):
+        names.extend(index.get(get_birthday_key(2, 29), []))
+    return names
+
+
+def get_birthdays(force_refresh: bool = False) -> Tuple[List[str], List[str]]:
+    # Birthdays hardly ever change, so contacts are only downloaded once a
+    # day and every refresh in between reads the persisted index.
+    today = date.today()
+    cached = read_json(BIRTHDAY_INDEX_NAME)
+    index = cached["birthdays"] if cached else None
+    if force_refresh or not cached or cached["refreshed"] != today.isoformat():
+        try:
+            index = refresh_birthday_index()
+        except Exception as e:
+            logger.critical(e)
+            if index is None:
+                if settings.GOOGLE_CONTACTS_GROUP:
+                    return [], ["Broken Credentials"]
+                return [], []
+            logger.warning("Using birthdays from %s", cached["refreshed"])
+    return get_birthdays_from_index(index, today)
+
+
+def get_cached_birthdays() -> Tuple[List[str], List[str]]:
+    cached = read_json(BIRTHDAY_INDEX_NAME)
+    return get_birthdays_from_index(cached["birthdays"] if cached else None, date.today())
+
+
+def get_birthdays_from_index(index: Optional[Dict[str, List[str]]], today: date) -> Tuple[List[str], List[str]]:
+    if index is None:
+        return [], []
+
+    birthday_names = get_birthday_names(index, today)
+    upcoming_birthday_names: List[str] = []
+    for days in range(1, UPCOMING_BIRTHDAY_DAYS):
+        day = today + timedelta(days=days)
+        for name in get_birthday_names(index, day):
+            upcoming_birthday_names.append(f"{name} ({ordinal(day.day)})")
+    return birthday_names, upcoming_birthday_names
@@ -1,21 +1,31 @@
 import logging
 import os
+from dataclasses import dataclass
 from datetime import date
-from typing import List, Tuple
+from functools import lru_cache
+from hashlib import sha1
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 from PIL.Image import Image as TImage
 from PIL.ImageDraw import ImageDraw as TImageDraw
 
-from holidays import get_todays_holiday
+from cache import read_bytes, read_json, write_bytes, write_json
 
 logger = logging.getLogger('app')
 CURRENT_PATH = os.path.dirname(os.path.realpath(__file__))
 PICTURES_PATH = os.path.join(CURRENT_PATH, 'pictures')
+FONTS_PATH = os.path.join(CURRENT_PATH, 'fonts')
+TEXT_CACHE_SIZE = 1024
+LAST_FRAME_NAME = "frame.bin"
+LAST_FRAME_INFO_NAME = "frame.json"
 _IMAGE = Image.new("RGB", (200, 100), (255, 255, 255))
 DRAW = ImageDraw.Draw(_IMAGE)
 
+# (left, top, right, bottom), right and bottom exclusive
+Box = Tuple[int, int, int, int]
+
 
 def init_display(epd):
     logger.info("Init display")
@@ -27,36 +37,130 @@ def clear_display(epd):
     epd.Clear()
 
 
+def init_partial_display(epd):
+    logger.info("Init display for partial refresh")
+    epd.init_part()
+
+
 def set_sleep(epd):
     logger.info("Set display to sleep-mode")
     epd.sleep()
 
 
+def get_frame_hash(buffer: bytes) -> str:
+    return sha1(buffer).hexdigest()
+
+
+def load_last_frame_hash() -> Optional[str]:
+    info = read_json(LAST_FRAME_INFO_NAME)
+    return info.get("hash") if info else None
+
+
+def load_last_frame() -> Optional[bytes]:
+    buffer = read_bytes(LAST_FRAME_NAME)
+    if buffer is None or get_frame_hash(buffer) != load_last_frame_hash():
+        return None
+    return buffer
+
+
+def save_last_frame(buffer: bytes, frame_hash: str):
+    # The buffer first: a frame.json that does not match it makes load_last_frame ignore both.
+    write_bytes(LAST_FRAME_NAME, buffer)
+    write_json(LAST_FRAME_INFO_NAME, {"hash": frame_hash})
+
+
+def get_changed_regions(previous: bytes, buffer: bytes, row_bytes: int, regions: Dict[str, Box]) -> List[str]:
+    # Regions are compared on the packed buffers, so their boxes must be byte-aligned panel boxes.
+    return [
+        name for name, box in regions.items()
+        if get_window_buffer(previous, row_bytes, box) != get_window_buffer(buffer, row_bytes, box)
+    ]
+
+
+def get_bounding_box(boxes: Iterable[Box]) -> Box:
+    lefts, tops, rights, bottoms = zip(*boxes)
+    return min(lefts), min(tops), max(rights), max(bottoms)
+
+
+def get_panel_box(box: Box, image_size: Tuple[int, int], rotate: bool, panel_size: Tuple[int, int]) -> Box:
+    """Map a box on the drawn image to panel coordinates, widened to whole bytes.
+
+    Follows show_content (optional 180° turn) and getbuffer (90° turn when the
+    image is portrait), so the box covers the same pixels once they are packed.
+    """
+    left, top, right, bottom = box
+    width, height = image_size
+    if rotate:
+        left, top, right, bottom = width - right, height - bottom, width - left, height - top
+    if (width, height) != panel_size:
+        left, top, right, bottom = top, width - right, bottom, width - left
+    return left // 8 * 8, top, min(-(-right // 8) * 8, panel_size[0]), bottom
+
+
+def get_window_buffer(buffer: bytes, row_bytes: int, box: Box) -> bytes:
+    # The rows of a packed 1-bit frame buffer that fall inside a byte-aligned box.
+    left, top, right, bottom = box
+    return b"".join(
+        bytes(buffer[row * row_bytes + left // 8:row * row_bytes + right // 8]) for row in range(top, bottom)
+    )
+
+
 def draw_text_centered(text: str, point: Tuple[float, float], canvas: TImageDraw, text_font: ImageFont.FreeTypeFont):
     # getsize removed in pillow 6
     # stead use bounded box
     # text_width, _ = text_font.getsize(text)
-    bbox = DRAW.textbbox((0, 0), text, font=font)
-    text_width = bbox[2] - bbox[0]
+    text_width = get_font_width(text_font, text)
     canvas.text((point[0] - text_width/2, point[1]),
                 text, font=text_font, fill=0)
 
 
-def get_font_height(font: ImageFont.FreeTypeFont):
+@dataclass(frozen=True)
+class FontMetrics:
+    ascent: int
+    descent: int
+    line_height: int
+
+
+@lru_cache(maxsize=None)
+def get_font(face: str, size: int) -> ImageFont.FreeTypeFont:
+    # Loaded on first use and shared, so every (face, size) is opened once per process.
+    logger.debug("Loading font %s at %s", face, size)
+    return ImageFont.truetype(os.path.join(FONTS_PATH, face), size)
+
+
+@lru_cache(maxsize=None)
+def get_font_metrics(font: ImageFont.FreeTypeFont) -> FontMetrics:
+    ascent, descent = font.getmetrics()
     # getsize removed in pillow 6
     # stead use bounded box
     # _, text_height = font.getsize("A")
     bbox = DRAW.textbbox((0, 0), "A", font=font)
-    text_height = bbox[3] - bbox[1]
-    return text_height
+    return FontMetrics(ascent, descent, bbox[3] - bbox[1])
+
+
+def get_font_height(font: ImageFont.FreeTypeFont):
+    return get_font_metrics(font).line_height
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def get_text_bbox(font: ImageFont.FreeTypeFont, text: str) -> Tuple[int, int, int, int]:
+    # Fonts come from get_font and live for the whole process, so the cache
+    # carries over between renders when the calendar keeps running.
+    return DRAW.textbbox((0, 0), text, font=font)
 
 
 def get_font_width(font: ImageFont.FreeTypeFont, text: str):
-    bbox = DRAW.textbbox((0, 0), text, font=font)
+    bbox = get_text_bbox(font, text)
     text_width = bbox[2] - bbox[0]
     return text_width
 
 
+def log_text_cache_stats():
+    info = get_text_bbox.cache_info()
+    logger.info("Text measurements: %s hits, %s misses, %s/%s cached",
+                info.hits, info.misses, info.currsize, info.maxsize)
+
+
 def convert_image_to_screen(image: TImage) -> TImage:
     def convert_f(e):
         if (e > 0):
@@ -70,7 +174,7 @@ def convert_image_to_screen(image: TImage) -> TImage:
     return Image.fromarray(converted_image_array, "RGB")
 
 
-def get_footer_images(has_birthday=False) -> List[TImage]:
+def get_footer_images(has_birthday=False, holiday: Optional[str] = None, today: Optional[date] = None) -> List[TImage]:
     def load_picture(name: str) -> TImage:
         file_path = os.path.join(PICTURES_PATH, name)
         if os.path.exists(file_path):
@@ -84,7 +188,7 @@ def get_footer_images(has_birthday=False) -> List[TImage]:
         else:
             return 0
 
-    today = date.today()
+    today = today or date.today()
     image_cake_names = ["Cake_icon.gif", "Cake_icon_on.gif"]
 
     image_list = []
@@ -93,7 +197,6 @@ def get_footer_images(has_birthday=False) -> List[TImage]:
     image_list.append(load_picture(image_cake_names[bool_to_array_index(has_birthday)]))
 
     # Holidays
-    holiday = get_todays_holiday()
     if holiday:
         holiday = holiday.replace("’", "").replace(" ", "_").capitalize()
         icon = load_picture(f"{holiday}_icon.png")
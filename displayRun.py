@@ -1,19 +1,28 @@
 #!/usr/bin/python3
+import argparse
 import calendar
 import locale
 import logging
+import math
 import os
 import time
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Dict, Optional
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from PIL.Image import Image as TImage
 from PIL.ImageDraw import ImageDraw as TImageDraw
 
-from dataHelper import get_birthdays, get_events
-from displayHelpers import clear_display, get_font_height, get_font_width, get_footer_images, init_display, set_sleep
+import httpClient
+import settings
+from dataFetcher import DisplayData, fetch_display_data, load_snapshot
+from displayHelpers import (Box, clear_display, get_bounding_box, get_changed_regions, get_font, get_font_height,
+                            get_font_metrics, get_font_width, get_footer_images, get_frame_hash, get_panel_box,
+                            get_window_buffer, init_display, init_partial_display, load_last_frame,
+                            load_last_frame_hash, log_text_cache_stats, save_last_frame, set_sleep)
 from settings import DEBUG, LOCALE, ROTATE_IMAGE
-from weather import get_weather
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
                     format="%(asctime)s - %(levelname)s, %(module)s:%(lineno)s - %(message)s",
@@ -25,28 +34,41 @@ MAX_EVENTS = 15
 
 CURRENT_DICT = os.path.dirname(os.path.realpath(__file__))
 PICTURE_DICT = os.path.join(CURRENT_DICT, 'pictures')
-FONT_DICT = os.path.join(CURRENT_DICT, 'fonts')
-
-FONT_ROBOTO_DATE = ImageFont.truetype(os.path.join(FONT_DICT, 'Roboto-Black.ttf'), 150)
-FONT_ROBOTO_H1 = ImageFont.truetype(os.path.join(FONT_DICT, 'Roboto-Black.ttf'), 40)
-FONT_ROBOTO_H2 = ImageFont.truetype(os.path.join(FONT_DICT, 'Roboto-Black.ttf'), 30)
-FONT_ROBOTO_P = ImageFont.truetype(os.path.join(FONT_DICT, 'Roboto-Black.ttf'), 20)
-FONT_ROBOTO_W = ImageFont.truetype(os.path.join(FONT_DICT, 'Roboto-Black.ttf'), 18)
-FONT_ROBOTO_BIRTH = ImageFont.truetype(os.path.join(FONT_DICT, 'Roboto-Black.ttf'), 18)
-FONT_POPPINS_BOLD_P = ImageFont.truetype(os.path.join(FONT_DICT, 'Poppins-Bold.ttf'), 20)
-FONT_POPPINS_P = ImageFont.truetype(os.path.join(FONT_DICT, 'Poppins-Regular.ttf'), 20)
+
+# (face, size) pairs, loaded on first use through get_font
+FONT_ROBOTO_DATE = ('Roboto-Black.ttf', 150)
+FONT_ROBOTO_H1 = ('Roboto-Black.ttf', 40)
+FONT_ROBOTO_H2 = ('Roboto-Black.ttf', 30)
+FONT_ROBOTO_P = ('Roboto-Black.ttf', 20)
+FONT_ROBOTO_W = ('Roboto-Black.ttf', 18)
+FONT_ROBOTO_BIRTH = ('Roboto-Black.ttf', 18)
+FONT_POPPINS_BOLD_P = ('Poppins-Bold.ttf', 20)
+FONT_POPPINS_P = ('Poppins-Regular.ttf', 20)
 LINE_WIDTH = 3
 
+# Off until checked on a panel: each run ends in deep sleep, so the controller may
+# no longer hold the previous frame the partial update is drawn against.
+PARTIAL_REFRESH = False
+PARTIAL_REFRESH_MAX_AREA = 0.6
+# A new day always gets a full refresh, which also clears the ghosting partial refreshes leave behind.
+FULL_REFRESH_REGIONS = {"date"}
+
 if DEBUG:
+    from lib import epdbuffer
+
     class FakeEPD:
         def __init__(self):
             self.width = 800
             self.height = 480
+
+        def getbuffer(self, image: TImage) -> bytes:
+            # Packed like epd7in5_V2.getbuffer, so frames are compared the same way while debugging.
+            return epdbuffer.getbuffer_mono(image, self.width, self.height, invert=True, rotate_first=True)
 else:
     from lib import epd7in5_V2
 
 
-def main():
+def main(replay: Optional[str] = None):
     logger.info(datetime.now())
     try:
         if DEBUG:
@@ -59,8 +81,19 @@ def main():
             PICTURE_DICT, "blank-hk.bmp"))
         draw = ImageDraw.Draw(image)
 
-        render_content(draw, image, epd.width, epd.height)
-        show_content(epd, image)
+        if replay:
+            logger.info("Rendering from snapshot %s", replay)
+            data = load_snapshot(replay)
+        else:
+            data = fetch_display_data(MAX_EVENTS)
+        render_content(draw, image, epd.width, epd.height, data)
+        httpClient.log_metrics()
+        log_text_cache_stats()
+        if replay:
+            # Leave the panel and the stored frame alone, so the next real run compares against what is shown.
+            export_content(image)
+        else:
+            show_content(epd, image, get_layout(*image.size).regions)
         #clear_content(epd)
 
     except Exception as e:
@@ -71,155 +104,288 @@ def main():
         raise e
 
 
-def render_content(draw: TImageDraw, image: TImage,  height: int, width: int):
+@dataclass(frozen=True)
+class Layout:
+    """Where every region of the frame goes, for one panel size.
+
+    The y positions are kept as floats so text lands on the same pixels as
+    before; regions holds the (left, top, right, bottom) box of each region,
+    against which a new frame is compared with the last one.
+    """
+    width: int
+    height: int
+    padding_l: int
+    padding_r: int
+    padding_top: int
+    header_top: float
+    date_top: float
+    day_top: float
+    divider_top: float
+    tally_top: float
+    tally_height: float
+    events_top: float
+    footer_top: int
+    regions: Dict[str, Box]
+
+
+@lru_cache(maxsize=None)
+def get_layout(width: int, height: int) -> Layout:
+    padding_l = int(width/45)
+    padding_r = int(width/30)
+    padding_top = int(height/30)
+    footer_top = int(height * 0.82)
+
+    header_top = padding_top * 0.75
+    date_top = header_top + LINE_WIDTH + get_font_height(get_font(*FONT_ROBOTO_H2))
+    day_top = date_top + get_font_height(get_font(*FONT_ROBOTO_DATE)) + padding_top
+    divider_top = day_top + get_font_height(get_font(*FONT_ROBOTO_P)) + padding_top
+    tally_top = divider_top + 10
+    tally_height = height/50
+    events_top = tally_top + tally_height + height/50
+
+    # The boxes tile the frame, so every pixel belongs to exactly one region:
+    # header and date on the left, weather in the column to their right
+    # (the rules under them run across it), then full-width bands. Band
+    # edges are multiples of 8 rows, which become whole bytes on the panel.
+    half_line = LINE_WIDTH // 2
+    month_metrics = get_font_metrics(get_font(*FONT_ROBOTO_H2))
+    date_band = -(-math.ceil(header_top + month_metrics.ascent + month_metrics.descent) // 8) * 8
+    tally_band = -(-(int(divider_top) + half_line + 1) // 8) * 8
+    events_band = -(-(int(tally_top + tally_height) + 1) // 8) * 8
+    footer_band = (footer_top - half_line) // 8 * 8
+    regions = {
+        "header": (0, 0, width // 2, date_band),
+        "date": (0, date_band, width // 2, tally_band),
+        "weather": (width // 2, 0, width, tally_band),
+        "tally": (0, tally_band, width, events_band),
+        "events": (0, events_band, width, footer_band),
+        "footer": (0, footer_band, width, height),
+    }
+    return Layout(width, height, padding_l, padding_r, padding_top, header_top, date_top, day_top, divider_top,
+                  tally_top, tally_height, events_top, footer_top, regions)
+
+
+def render_content(draw: TImageDraw, image: TImage,  height: int, width: int, data: DisplayData):
+    """Draw the whole frame for data.
+
+    The renderers are not clipped to their region's box (the header rule runs
+    across the weather box), so the frame is always drawn whole; the boxes
+    only tell which parts of it changed since the last one.
+    """
     locale.setlocale(locale.LC_ALL, LOCALE)
+    layout = get_layout(width, height)
+    for render in REGION_RENDERERS.values():
+        render(draw, image, layout, data)
 
-    PADDING_L = int(width/45)
-    PADDING_R = int(width/30)
-    PADDING_TOP = int(height/30)
-    FOOTER_HEIGHT = int(height * 0.82)
-    now = time.localtime()
-    max_days_in_month = calendar.monthrange(now.tm_year, now.tm_mon)[1]
-    day_str = time.strftime("%A")
-    day_number = now.tm_mday
-    month_str = time.strftime("%B")
-
-    # Heading
-    current_height = PADDING_TOP * 0.75
-    draw.line((PADDING_L, current_height, width - PADDING_R, current_height), fill=1, width=LINE_WIDTH)
-    draw.text((PADDING_L, current_height), month_str.upper(), font=FONT_ROBOTO_H2, fill=1)
-    current_height += LINE_WIDTH
-    current_height += get_font_height(FONT_ROBOTO_H2)
-
-    # Date
-    current_font_height = get_font_height(FONT_ROBOTO_DATE)
-    draw.text((PADDING_L * 0.75, current_height - current_font_height/10), str(day_number), font=FONT_ROBOTO_DATE, fill=1)
-    current_height += current_font_height
-    current_height += PADDING_TOP
-    draw.text((PADDING_L, current_height), f"{day_str.upper()}", font=FONT_ROBOTO_P, fill=1)
-
-    current_height += get_font_height(FONT_ROBOTO_P) + PADDING_TOP
-    draw.line((PADDING_L, current_height, width - PADDING_R, current_height), fill=1, width=LINE_WIDTH)
-
-    # Weather
-    weather = get_weather()
-    if weather:
-        weather_icon_width, weather_icon_height = weather.weather_icon.size
-        weather_height = PADDING_TOP
-
-        temperature_str = f"{weather.temp}º (Feels Like {weather.feels_like}º)"
-        weather_right_aligned = width - get_font_width(FONT_ROBOTO_P, temperature_str) - PADDING_R
-        weather_icon_right_aligned = width - weather_icon_width - PADDING_R
-
-        draw.text((weather_right_aligned, weather_height), temperature_str, font=FONT_ROBOTO_P, fill=1)
-        weather_height += get_font_height(FONT_ROBOTO_P) * 1.5
-        image.paste(weather.weather_icon, (round(weather_icon_right_aligned), round(weather_height + 10)))
-
-        high_low_str = f"Low {weather.temp_min} / High {weather.temp_max}"
-        weather_right_aligned = width - get_font_width(FONT_ROBOTO_W, high_low_str) - PADDING_R
-        draw.text((weather_right_aligned, weather_height), high_low_str, font=FONT_ROBOTO_W, fill=1)
-        weather_height += weather_icon_height
-
-        if weather.weather == "Rain":
-            weather_str = f"{weather.weather_desc} ({weather.rain}mm)"
-        elif weather.weather == "Snow":
-            weather_str = f"{weather.weather_desc} ({weather.snow})"
-        elif weather.weather == "Clouds":
-            weather_str = f"{weather.weather_desc} ({weather.clouds}%)"
-        else:
-            weather_str = f"{weather.weather_desc}"
-        weather_right_aligned = width - get_font_width(FONT_ROBOTO_W, weather_str) - PADDING_R
-        draw.text((weather_right_aligned, weather_height), weather_str, font=FONT_ROBOTO_W, fill=1)
-        weather_height += get_font_height(FONT_ROBOTO_W) * 1.5
-    else:
+
+def draw_header(draw: TImageDraw, image: TImage, layout: Layout, data: DisplayData):
+    month_str = data.now.strftime("%B")
+    current_height = layout.header_top
+    draw.line((layout.padding_l, current_height, layout.width - layout.padding_r, current_height),
+              fill=1, width=LINE_WIDTH)
+    draw.text((layout.padding_l, current_height), month_str.upper(), font=get_font(*FONT_ROBOTO_H2), fill=1)
+
+
+def draw_date(draw: TImageDraw, image: TImage, layout: Layout, data: DisplayData):
+    day_str = data.now.strftime("%A")
+    current_font_height = get_font_height(get_font(*FONT_ROBOTO_DATE))
+    draw.text((layout.padding_l * 0.75, layout.date_top - current_font_height/10), str(data.now.day),
+              font=get_font(*FONT_ROBOTO_DATE), fill=1)
+    draw.text((layout.padding_l, layout.day_top), f"{day_str.upper()}", font=get_font(*FONT_ROBOTO_P), fill=1)
+    draw.line((layout.padding_l, layout.divider_top, layout.width - layout.padding_r, layout.divider_top),
+              fill=1, width=LINE_WIDTH)
+
+
+def draw_weather(draw: TImageDraw, image: TImage, layout: Layout, data: DisplayData):
+    weather = data.weather
+    if not weather:
         logger.info("Skipping weather")
+        return
+    width = layout.width
+    padding_r = layout.padding_r
+    weather_icon_width, weather_icon_height = weather.weather_icon.size
+    weather_height = layout.padding_top
+
+    temperature_str = f"{weather.temp}º (Feels Like {weather.feels_like}º)"
+    weather_right_aligned = width - get_font_width(get_font(*FONT_ROBOTO_P), temperature_str) - padding_r
+    weather_icon_right_aligned = width - weather_icon_width - padding_r
+
+    draw.text((weather_right_aligned, weather_height), temperature_str, font=get_font(*FONT_ROBOTO_P), fill=1)
+    weather_height += get_font_height(get_font(*FONT_ROBOTO_P)) * 1.5
+    image.paste(weather.weather_icon, (round(weather_icon_right_aligned), round(weather_height + 10)))
+
+    high_low_str = f"Low {weather.temp_min} / High {weather.temp_max}"
+    weather_right_aligned = width - get_font_width(get_font(*FONT_ROBOTO_W), high_low_str) - padding_r
+    draw.text((weather_right_aligned, weather_height), high_low_str, font=get_font(*FONT_ROBOTO_W), fill=1)
+    weather_height += weather_icon_height
+
+    if weather.weather == "Rain":
+        weather_str = f"{weather.weather_desc} ({weather.rain}mm)"
+    elif weather.weather == "Snow":
+        weather_str = f"{weather.weather_desc} ({weather.snow})"
+    elif weather.weather == "Clouds":
+        weather_str = f"{weather.weather_desc} ({weather.clouds}%)"
+    else:
+        weather_str = f"{weather.weather_desc}"
+    weather_right_aligned = width - get_font_width(get_font(*FONT_ROBOTO_W), weather_str) - padding_r
+    draw.text((weather_right_aligned, weather_height), weather_str, font=get_font(*FONT_ROBOTO_W), fill=1)
 
+
+def draw_tally(draw: TImageDraw, image: TImage, layout: Layout, data: DisplayData):
     # Month-Tally-Overview
-    current_height += 10
-    tally_height = height/50
-    tally_width = LINE_WIDTH + width/120  # width + padding
-    available_width = width - PADDING_L - PADDING_R
-    tally_number = int(available_width / tally_width * (day_number / max_days_in_month))
-    x_position = PADDING_L + LINE_WIDTH/2
+    now = data.now
+    max_days_in_month = calendar.monthrange(now.year, now.month)[1]
+    current_height = layout.tally_top
+    tally_width = LINE_WIDTH + layout.width/120  # width + padding
+    available_width = layout.width - layout.padding_l - layout.padding_r
+    tally_number = int(available_width / tally_width * (now.day / max_days_in_month))
+    x_position = layout.padding_l + LINE_WIDTH/2
     for i in range(0, tally_number):
         draw.line(
-            (x_position, current_height, x_position, current_height + tally_height),
+            (x_position, current_height, x_position, current_height + layout.tally_height),
             fill=1, width=LINE_WIDTH
         )
         x_position += tally_width
-    current_height += tally_height
 
-    # Calendar
-    current_height += height/50
-    event_list = get_events(MAX_EVENTS)
 
-    last_event_day = datetime.now().date()
-    for event in event_list:
+def draw_events(draw: TImageDraw, image: TImage, layout: Layout, data: DisplayData):
+    padding_l = layout.padding_l
+    current_height = layout.events_top
+
+    last_event_day = data.now.date()
+    for event in data.events:
         # Draw new day
         if last_event_day != event.start.date():
-            current_height += height/80
+            current_height += layout.height/80
             last_event_day = event.start.date()
             day_string = last_event_day.strftime("%a %d")
-            draw.text((PADDING_L, current_height), day_string, font=FONT_ROBOTO_P, fill=1)
-            current_height += get_font_height(FONT_ROBOTO_P) * 1.5
+            draw.text((padding_l, current_height), day_string, font=get_font(*FONT_ROBOTO_P), fill=1)
+            current_height += get_font_height(get_font(*FONT_ROBOTO_P)) * 1.5
 
         # Draw event
         if event.all_day:
-            draw.text((PADDING_L, current_height), " - : -", font=FONT_POPPINS_P, fill=1)
+            draw.text((padding_l, current_height), " - : -", font=get_font(*FONT_POPPINS_P), fill=1)
         else:
-            draw.text((PADDING_L, current_height), event.start.strftime("%H:%M"), font=FONT_POPPINS_P, fill=1)
+            draw.text((padding_l, current_height), event.start.strftime("%H:%M"),
+                      font=get_font(*FONT_POPPINS_P), fill=1)
 
         summmary_padding = 60
-        draw.text((PADDING_L + summmary_padding, current_height), event.summary, font=FONT_POPPINS_P, fill=1)
-        current_height += get_font_height(FONT_POPPINS_P) * 1.5
+        draw.text((padding_l + summmary_padding, current_height), event.summary, font=get_font(*FONT_POPPINS_P), fill=1)
+        current_height += get_font_height(get_font(*FONT_POPPINS_P)) * 1.5
 
-        if current_height + get_font_height(FONT_ROBOTO_P) + get_font_height(FONT_POPPINS_P) * 3 >= FOOTER_HEIGHT:
+        if current_height + get_font_height(get_font(*FONT_ROBOTO_P)) + \
+                get_font_height(get_font(*FONT_POPPINS_P)) * 3 >= layout.footer_top:
             break
 
+
+def draw_footer(draw: TImageDraw, image: TImage, layout: Layout, data: DisplayData):
     # Footer Icons
-    current_height = FOOTER_HEIGHT
-    draw.line((PADDING_L, current_height, width - PADDING_R, current_height), fill=1, width=LINE_WIDTH)
+    padding_l = layout.padding_l
+    current_height = layout.footer_top
+    draw.line((padding_l, current_height, layout.width - layout.padding_r, current_height), fill=1, width=LINE_WIDTH)
     current_height += 5
 
-    bithday_persons, upcoming_birthday_persons = get_birthdays()
+    bithday_persons, upcoming_birthday_persons = data.birthdays, data.upcoming_birthdays
     draw_cake = len(bithday_persons) > 0
-    image_padding = PADDING_L
+    image_padding = padding_l
     image_height = 0
-    for botton_image in get_footer_images(draw_cake):
+    for botton_image in get_footer_images(draw_cake, data.holiday, data.now.date()):
         image.paste(botton_image, (image_padding, current_height))
 
         image_width, image_height = botton_image.size
-        image_padding += image_width + PADDING_L
+        image_padding += image_width + padding_l
     current_height += image_height
 
     # Draw name of birthday-person
     if draw_cake:
         bithday_persons_string = ", ".join(bithday_persons)
         draw.text(
-            (PADDING_L, current_height),
+            (padding_l, current_height),
             f"Birthdays: {bithday_persons_string}",
-            font=FONT_ROBOTO_BIRTH, fill=1
+            font=get_font(*FONT_ROBOTO_BIRTH), fill=1
         )
-        current_height += get_font_height(FONT_ROBOTO_P) * 1.5
+        current_height += get_font_height(get_font(*FONT_ROBOTO_P)) * 1.5
     if upcoming_birthday_persons:
         upcoming_birthday_persons_string = ", ".join(upcoming_birthday_persons)
         draw.text(
-            (PADDING_L, current_height),
+            (padding_l, current_height),
             f"Upcoming: {upcoming_birthday_persons_string}",
-            font=FONT_ROBOTO_BIRTH, fill=1
+            font=get_font(*FONT_ROBOTO_BIRTH), fill=1
         )
 
 
-def show_content(epd, image: TImage):
+REGION_RENDERERS: Dict[str, Callable[[TImageDraw, TImage, Layout, DisplayData], None]] = {
+    "header": draw_header,
+    "date": draw_date,
+    "weather": draw_weather,
+    "tally": draw_tally,
+    "events": draw_events,
+    "footer": draw_footer,
+}
+
+
+def get_refresh_window(previous: Optional[bytes], buffer: bytes, row_bytes: int,
+                       regions: Dict[str, Box]) -> Optional[Box]:
+    """Return the panel box to refresh partially, or None for a full refresh.
+
+    regions are panel boxes, as returned by get_panel_box.
+    """
+    if not getattr(settings, "PARTIAL_REFRESH", PARTIAL_REFRESH):
+        return None
+    if previous is None or len(previous) != len(buffer):
+        logger.info("No previous frame to compare with, doing a full refresh")
+        return None
+
+    changed = get_changed_regions(previous, buffer, row_bytes, regions)
+    if FULL_REFRESH_REGIONS.intersection(changed):
+        logger.info("Regions changed: %s, doing a full refresh", ", ".join(changed))
+        return None
+    window = get_bounding_box(regions[name] for name in changed)
+    left, top, right, bottom = window
+    share = (right - left) * (bottom - top) / (len(buffer) * 8)
+    if share > getattr(settings, "PARTIAL_REFRESH_MAX_AREA", PARTIAL_REFRESH_MAX_AREA):
+        logger.info("Regions changed: %s (%.0f%% of the frame), doing a full refresh", ", ".join(changed), share * 100)
+        return None
+    logger.info("Regions changed: %s (%.0f%% of the frame), refreshing %s partially",
+                ", ".join(changed), share * 100, window)
+    return window
+
+
+def export_content(image: TImage):
     logger.info("Exporting final image")
     image.save("EXPORT.bmp")
+
+
+def show_content(epd, image: TImage, regions: Dict[str, Box]):
+    export_content(image)
+    start = time.monotonic()
+    panel_regions = {
+        name: get_panel_box(box, image.size, ROTATE_IMAGE, (epd.width, epd.height)) for name, box in regions.items()
+    }
     if ROTATE_IMAGE:
         image = image.rotate(180)
+    buffer = bytes(epd.getbuffer(image))
+    frame_hash = get_frame_hash(buffer)
+    if frame_hash == load_last_frame_hash():
+        logger.info("Frame unchanged (%s), skipping the display refresh after %.0fms",
+                    frame_hash[:12], (time.monotonic() - start) * 1000)
+        return
+
+    window = get_refresh_window(load_last_frame(), buffer, epd.width // 8, panel_regions)
+    logger.info("Frame %s compared in %.0fms", frame_hash[:12], (time.monotonic() - start) * 1000)
     if not DEBUG:
-        init_display(epd)
-        logger.info("Writing on display")
-        epd.display(epd.getbuffer(image))
+        start = time.monotonic()
+        if window:
+            init_partial_display(epd)
+            logger.info("Writing %s on display", window)
+            epd.display_Partial(get_window_buffer(buffer, epd.width // 8, window), *window)
+        else:
+            init_display(epd)
+            logger.info("Writing on display")
+            epd.display(buffer)
         set_sleep(epd)
+        logger.info("%s refresh took %.1fs", "Partial" if window else "Full", time.monotonic() - start)
+    save_last_frame(buffer, frame_hash)
 
 
 def clear_content(epd):
@@ -232,4 +398,7 @@ def clear_content(epd):
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", metavar="SNAPSHOT",
+                        help="render from a snapshot file (e.g. cache/snapshot.json) without any network access")
+    main(parser.parse_args().replay)
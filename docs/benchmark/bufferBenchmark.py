@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+"""Time the frame buffer packing in lib/epdbuffer against the per-pixel loops it replaced.
+
+Also compares building the two planes epd7in5_V2.display sends, in time and peak memory,
+the 4-grey getbuffer_4Gray and display_4Gray packing, and the colour panels' palette packing.
+
+Runs on any machine with Pillow and numpy, no panel needed:
+
+    python docs/benchmark/bufferBenchmark.py --repeat 5
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from lib import epdbuffer  # noqa: E402
+
+# (name, width, height) of the monochrome panels, as in lib/
+PANELS = [
+    ("epd1in54", 200, 200),
+    ("epd2in13", 122, 250),
+    ("epd2in9", 128, 296),
+    ("epd4in2", 400, 300),
+    ("epd5in83_V2", 648, 480),
+    ("epd7in5_V2", 800, 480),
+    ("epd7in5b_HD", 880, 528),
+    ("epd13in3k", 960, 680),
+]
+
+
+def loop_getbuffer(image, width, height):
+    # What most drivers did before: set a bit per black pixel.
+    linewidth = (width + 7) // 8
+    buf = [0xFF] * (linewidth * height)
+    image_monocolor = image.convert('1')
+    pixels = image_monocolor.load()
+    for y in range(height):
+        for x in range(width):
+            if pixels[x, y] == 0:
+                buf[x // 8 + y * linewidth] &= ~(0x80 >> (x % 8))
+    return buf
+
+
+def loop_invert_getbuffer(image, width, height):
+    # What epd7in5_V2 and its siblings did before: invert byte by byte.
+    buf = bytearray(image.convert('1').tobytes('raw'))
+    for i in range(len(buf)):
+        buf[i] ^= 0xFF
+    return buf
+
+
+def loop_display_planes(buf, width, height):
+    # What epd7in5_V2.display did before: a list of complemented (negative) ints.
+    linewidth = (width + 7) // 8
+    image1 = [0xFF] * int(width * height / 8)
+    for j in range(height):
+        for i in range(linewidth):
+            image1[i + j * linewidth] = ~buf[i + j * linewidth]
+    return image1, buf
+
+
+def bulk_display_planes(buf, width, height):
+    return epdbuffer.invert(buf), buf
+
+
+def loop_getbuffer_gray4(image, width, height):
+    # What getbuffer_4Gray did before: 4 pixels per byte, taking 0xC0 and 0x80 a shade darker.
+    buf = [0xFF] * (width // 4 * height)
+    image_grey = image.convert('L')
+    pixels = image_grey.load()
+    for y in range(height):
+        for x in range(width):
+            if pixels[x, y] == 0xC0:
+                pixels[x, y] = 0x80
+            elif pixels[x, y] == 0x80:
+                pixels[x, y] = 0x40
+            if x % 4 == 3:
+                buf[(x + y * width) // 4] = ((pixels[x - 3, y] & 0xC0) | (pixels[x - 2, y] & 0xC0) >> 2
+                                             | (pixels[x - 1, y] & 0xC0) >> 4 | (pixels[x, y] & 0xC0) >> 6)
+    return buf
+
+
+def loop_gray4_planes(buf):
+    # What display_4Gray did before: one bit per pixel and plane, a byte at a time.
+    planes = ([], [])
+    for i in range(len(buf) // 2):
+        high = low = 0
+        for temp in buf[i * 2:i * 2 + 2]:
+            for _ in range(4):
+                high = high << 1 | (temp & 0x80) >> 7
+                low = low << 1 | (temp & 0x40) >> 6
+                temp <<= 2
+        planes[0].append(high)
+        planes[1].append(low)
+    return planes
+
+
+# (name, width, height, palette, bits per pixel) of some colour panels, as in lib/
+COLOUR_PANELS = [
+    ("epd2in13g", 122, 250, (0, 0, 0, 255, 255, 255, 255, 255, 0, 255, 0, 0), 2),
+    ("epd4in37g", 512, 368, (0, 0, 0, 255, 255, 255, 255, 255, 0, 255, 0, 0), 2),
+    ("epd5in65f", 600, 448, (0, 0, 0, 255, 255, 255, 0, 255, 0, 0, 0, 255, 255, 0, 0, 255, 255, 0, 255, 128, 0), 4),
+    ("epd7in3f", 800, 480, (0, 0, 0, 255, 255, 255, 0, 255, 0, 0, 0, 255, 255, 0, 0, 255, 255, 0, 255, 128, 0), 4),
+]
+
+
+def loop_getbuffer_palette(image, width, height, palette, bits):
+    # What the colour drivers did before: quantize, then pack the indices one byte at a time.
+    indices = bytearray(image.convert("RGB").quantize(palette=epdbuffer.palette_image(palette)).tobytes('raw'))
+    per_byte = 8 // bits
+    row_bytes = (width + per_byte - 1) // per_byte
+    buf = [0x00] * (row_bytes * height)
+    idx = 0
+    for j in range(height):
+        for i in range(row_bytes):
+            for k in range(min(per_byte, width - i * per_byte)):
+                buf[i + j * row_bytes] += indices[idx] << (8 - bits * (k + 1))
+                idx += 1
+    return buf
+
+
+def peak_memory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def best_of(repeat, function, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best one counts")
+    options = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'panel':<14}{'size':>10}  {'getbuffer loop':>15}{'bulk':>9}  {'invert loop':>12}{'bulk':>9}")
+    for name, width, height in PANELS:
+        # Already 1-bit, so the timings are about packing rather than dithering.
+        image = Image.fromarray(rng.integers(0, 2, (height, width), dtype=np.uint8) * 255, 'L').convert('1')
+
+        loop_time, loop_buf = best_of(options.repeat, loop_getbuffer, image, width, height)
+        bulk_time, bulk_buf = best_of(options.repeat, epdbuffer.getbuffer_mono, image, width, height)
+        assert bytes(loop_buf) == bytes(bulk_buf), name
+        invert_time, invert_buf = best_of(options.repeat, loop_invert_getbuffer, image, width, height)
+        bulk_invert_time, bulk_invert_buf = best_of(options.repeat, epdbuffer.getbuffer_mono, image, width, height,
+                                                    True)
+        assert width % 8 or bytes(invert_buf) == bytes(bulk_invert_buf), name
+
+        print(f"{name:<14}{f'{width}x{height}':>10}  {loop_time * 1000:13.1f}ms{bulk_time * 1000:7.2f}ms"
+              f"  {invert_time * 1000:10.1f}ms{bulk_invert_time * 1000:7.2f}ms")
+
+    print()
+    print(f"{'display planes':<24}  {'loop':>9}{'bulk':>9}  {'loop peak':>10}{'bulk peak':>10}")
+    for name, width, height in PANELS:
+        if width % 8:
+            continue
+        image = Image.fromarray(rng.integers(0, 2, (height, width), dtype=np.uint8) * 255, 'L').convert('1')
+        buf = epdbuffer.getbuffer_mono(image, width, height, True)
+        loop_time, (loop_old, _) = best_of(options.repeat, loop_display_planes, buf, width, height)
+        bulk_time, (bulk_old, _) = best_of(options.repeat, bulk_display_planes, buf, width, height)
+        assert bytes(b & 0xFF for b in loop_old) == bulk_old, name
+        loop_peak = peak_memory(loop_display_planes, buf, width, height)
+        bulk_peak = peak_memory(bulk_display_planes, buf, width, height)
+        print(f"{name:<14}{f'{width}x{height}':>10}  {loop_time * 1000:7.1f}ms{bulk_time * 1000:7.2f}ms"
+              f"  {loop_peak / 1024:7.0f}KiB{bulk_peak / 1024:7.0f}KiB")
+
+    print()
+    print(f"{'4-grey':<24}  {'getbuffer loop':>15}{'bulk':>9}  {'planes loop':>12}{'bulk':>9}")
+    for name, width, height in PANELS:
+        if width % 8:
+            continue
+        # Every grey level, so the 0xC0 and 0x80 special cases are covered.
+        image = Image.fromarray(rng.integers(0, 256, (height, width), dtype=np.uint8), 'L')
+        loop_time, loop_buf = best_of(options.repeat, loop_getbuffer_gray4, image, width, height)
+        bulk_time, bulk_buf = best_of(options.repeat, epdbuffer.getbuffer_gray4, image, width, height)
+        assert bytes(loop_buf) == bytes(bulk_buf), name
+        planes_time, loop_planes = best_of(options.repeat, loop_gray4_planes, bulk_buf)
+        bulk_planes_time, bulk_planes = best_of(options.repeat, epdbuffer.gray4_planes, bulk_buf)
+        assert tuple(map(bytes, loop_planes)) == bulk_planes, name
+        print(f"{name:<14}{f'{width}x{height}':>10}  {loop_time * 1000:13.1f}ms{bulk_time * 1000:7.2f}ms"
+              f"  {planes_time * 1000:10.1f}ms{bulk_planes_time * 1000:7.2f}ms")
+
+    print()
+    print(f"{'colour':<24}  {'getbuffer loop':>15}{'bulk':>9}")
+    for name, width, height, palette, bits in COLOUR_PANELS:
+        # Both quantize the same way, so most of what is left in bulk is the dithering.
+        image = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), 'RGB')
+        loop_time, loop_buf = best_of(options.repeat, loop_getbuffer_palette, image, width, height, palette, bits)
+        bulk_time, bulk_buf = best_of(options.repeat, epdbuffer.getbuffer_palette, image, width, height, palette,
+                                      bits)
+        assert bytes(loop_buf) == bytes(bulk_buf), name
+        print(f"{name:<14}{f'{width}x{height}':>10}  {loop_time * 1000:13.1f}ms{bulk_time * 1000:7.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+"""Local stand-in for every external service the calendar talks to.
+
+Serves recorded OpenWeatherMap and canada-holidays.ca responses, generated ICS
+feeds and a CardDAV address book, with optional latency and failure injection.
+Point settings.py at it to benchmark a refresh without any network:
+
+    OPENWEATHERMAP_URL = "http://localhost:8080"
+    HOLIDAY_API_URL = "http://localhost:8080/api/v1"
+    CALENDAR_URLS = ["http://localhost:8080/calendars/basic.ics?events=500"]
+    CALDAV_CONTACT_URL = "http://localhost:8080/carddav/"
+"""
+import argparse
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger('stub')
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+CARDDAV_PATH = "/carddav/"
+SYNC_TOKEN = "http://localhost/sync/1"
+
+
+def load_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES_PATH, name), 'rb') as fixture:
+        return fixture.read()
+
+
+def generate_calendar(event_count: int) -> bytes:
+    # Events start today so they always show up; every tenth one repeats weekly.
+    today = date.today()
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//eInkCalendar//Stub//EN", "X-WR-TIMEZONE:America/Toronto"]
+    for i in range(event_count):
+        start = datetime.combine(today + timedelta(days=i // 4), datetime.min.time()) + timedelta(hours=8 + (i % 4) * 3)
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:stub-event-{i}@localhost",
+            f"DTSTART;TZID=America/Toronto:{start:%Y%m%dT%H%M%S}",
+            f"DTEND;TZID=America/Toronto:{start + timedelta(hours=1):%Y%m%dT%H%M%S}",
+            f"SUMMARY:Stub event {i}",
+            "SEQUENCE:0",
+            f"LAST-MODIFIED:{today:%Y%m%d}T000000Z",
+        ]
+        if i % 10 == 0:
+            lines.append("RRULE:FREQ=WEEKLY")
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+def generate_vcard(i: int) -> str:
+    today = date.today()
+    birthday = today + timedelta(days=i % 365)
+    return "\r\n".join([
+        "BEGIN:VCARD",
+        "VERSION:3.0",
+        f"UID:stub-contact-{i}",
+        f"FN:Contact {i}",
+        f"N:{i};Contact;;;",
+        # Leap years only, so a birthday falling on Feb 29 is still a real date.
+        f"BDAY:{1980 + i % 8 * 4}-{birthday:%m-%d}",
+        "END:VCARD",
+        "",
+    ])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StubServer"
+
+    def log_message(self, format, *args):
+        logger.info("%s %s", self.address_string(), format % args)
+
+    def reply(self, status: int, body: bytes = b"", content_type: str = "application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> str:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+
+    def inject_faults(self) -> bool:
+        options = self.server.options
+        if options.latency:
+            time.sleep(options.latency * random.uniform(0.5, 1.5))
+        if random.random() < options.hang_rate:
+            time.sleep(options.hang_seconds)
+        if random.random() < options.failure_rate:
+            self.reply(503, b'{"message": "injected failure"}')
+            return True
+        return False
+
+    def do_GET(self):
+        if self.inject_faults():
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/geo/1.0/direct":
+            self.reply(200, load_fixture("geo.json"))
+        elif url.path == "/data/3.0/onecall":
+            self.reply(200, load_fixture("onecall.json"))
+        elif url.path.startswith("/api/v1/provinces/"):
+            year = query.get("year", [str(date.today().year)])[0]
+            body = re.sub(rb'"(\d{4})-(\d\d-\d\d)"', lambda m: b'"%s-%s"' % (year.encode(), m.group(2)),
+                          load_fixture("province.json"))
+            self.reply(200, body)
+        elif url.path.startswith("/calendars/"):
+            body = generate_calendar(int(query.get("events", [self.server.options.calendar_events])[0]))
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.reply(304, headers={"ETag": etag})
+            else:
+                self.reply(200, body, "text/calendar; charset=utf-8", {"ETag": etag})
+        elif url.path.startswith(CARDDAV_PATH) and url.path.endswith(".vcf"):
+            i = int(re.search(r"(\d+)\.vcf$", url.path).group(1))
+            self.reply(200, generate_vcard(i).encode(), "text/vcard; charset=utf-8")
+        else:
+            self.reply(404, b'{"message": "not found"}')
+
+    def do_PROPFIND(self):
+        self.read_body()
+        if self.inject_faults():
+            return
+        responses = "".join(
+            f"<d:response><d:href>{CARDDAV_PATH}{i}.vcf</d:href><d:propstat><d:prop>"
+            f"<d:getcontenttype>text/vcard; charset=utf-8</d:getcontenttype><d:getetag>\"{i}\"</d:getetag>"
+            "</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+            for i in range(self.server.options.contacts)
+        )
+        self.reply_multistatus(responses)
+
+    def do_REPORT(self):
+        body = self.read_body()
+        if self.inject_faults():
+            return
+        if "sync-collection" in body:
+            # Nothing ever changes, so any known token gets an empty delta.
+            if SYNC_TOKEN in body:
+                self.reply_multistatus("", SYNC_TOKEN)
+                return
+            hrefs = [f"{CARDDAV_PATH}{i}.vcf" for i in range(self.server.options.contacts)]
+            responses = "".join(
+                f"<d:response><d:href>{href}</d:href><d:propstat><d:prop><d:getetag>\"1\"</d:getetag></d:prop>"
+                "<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+                for href in hrefs
+            )
+            self.reply_multistatus(responses, SYNC_TOKEN)
+            return
+        responses = ""
+        for href in re.findall(r"<(?:\w+:)?href>([^<]*)</(?:\w+:)?href>", body):
+            i = int(re.search(r"(\d+)\.vcf$", href).group(1))
+            responses += (
+                f"<d:response><d:href>{href}</d:href><d:propstat><d:prop><d:getetag>\"{i}\"</d:getetag>"
+                f"<card:address-data>{escape(generate_vcard(i))}</card:address-data>"
+                "</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+            )
+        self.reply_multistatus(responses)
+
+    def reply_multistatus(self, responses: str, sync_token: str = None):
+        token = f"<d:sync-token>{sync_token}</d:sync-token>" if sync_token else ""
+        body = ('<?xml version="1.0" encoding="utf-8"?>'
+                '<d:multistatus xmlns:d="DAV:" xmlns:card="urn:ietf:params:xml:ns:carddav">'
+                f"{responses}{token}</d:multistatus>")
+        self.reply(207, body.encode(), "application/xml; charset=utf-8")
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, options: argparse.Namespace):
+        super().__init__((options.host, options.port), StubHandler)
+        self.options = options
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="average seconds added to every response")
+    parser.add_argument("--failure-rate", type=float, default=0, help="share of requests answered with a 503")
+    parser.add_argument("--hang-rate", type=float, default=0, help="share of requests that hang")
+    parser.add_argument("--hang-seconds", type=float, default=120, help="how long a hanging request hangs")
+    parser.add_argument("--calendar-events", type=int, default=200,
+                        help="events per calendar unless the URL has ?events=N")
+    parser.add_argument("--contacts", type=int, default=600, help="contacts in the address book")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    server = StubServer(options)
+    logger.info("Serving stubs on http://%s:%s", options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
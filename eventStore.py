@@ -0,0 +1,229 @@
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from hashlib import sha1
+from typing import Iterable, List, Optional, Set
+from zoneinfo import ZoneInfo
+
+from icalendar import Calendar
+from icalevents.icalevents import events
+from icalevents.icalparser import Event
+
+from cache import get_cache_file
+
+logger = logging.getLogger('app')
+
+EVENT_STORE_NAME = "events.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calendars (
+    url TEXT PRIMARY KEY,
+    body_hash TEXT,
+    timezones BLOB,
+    expanded_on TEXT,
+    expanded_until REAL
+);
+CREATE TABLE IF NOT EXISTS components (
+    url TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    recurrence_id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    recurring INTEGER NOT NULL,
+    ical BLOB NOT NULL,
+    PRIMARY KEY (url, uid, recurrence_id)
+);
+CREATE TABLE IF NOT EXISTS occurrences (
+    url TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    all_day INTEGER NOT NULL,
+    summary TEXT,
+    description TEXT,
+    location TEXT
+);
+CREATE INDEX IF NOT EXISTS occurrences_start ON occurrences (start);
+CREATE INDEX IF NOT EXISTS occurrences_uid ON occurrences (url, uid);
+"""
+
+
+def connect() -> sqlite3.Connection:
+    # One connection per thread; WAL lets the calendar workers write while others read.
+    conn = sqlite3.connect(get_cache_file(EVENT_STORE_NAME), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_calendar(conn: sqlite3.Connection, url: str) -> Optional[sqlite3.Row]:
+    return conn.execute("SELECT * FROM calendars WHERE url = ?", (url,)).fetchone()
+
+
+def set_expanded(conn: sqlite3.Connection, url: str, expanded_on: str, expanded_until: float):
+    with conn:
+        conn.execute(
+            "UPDATE calendars SET expanded_on = ?, expanded_until = ? WHERE url = ?",
+            (expanded_on, expanded_until, url)
+        )
+
+
+def get_component_version(component) -> str:
+    if "LAST-MODIFIED" in component:
+        return f"{component.get('SEQUENCE', 0)}|{component['LAST-MODIFIED'].to_ical().decode()}"
+    # Without LAST-MODIFIED there is no cheap way to tell, so compare the content.
+    return sha1(component.to_ical()).hexdigest()
+
+
+def get_body_hash(content: bytes) -> str:
+    return sha1(content).hexdigest()
+
+
+def set_body_hash(conn: sqlite3.Connection, url: str, body_hash: str):
+    with conn:
+        conn.execute("UPDATE calendars SET body_hash = ? WHERE url = ?", (body_hash, url))
+
+
+def update_components(conn: sqlite3.Connection, url: str, content: bytes) -> Optional[Set[str]]:
+    """Store the VEVENTs of a feed, returning the UIDs that changed or were removed.
+
+    Returns None without parsing when the feed body is the one already stored.
+    The body hash is only stored by set_body_hash once the changes are expanded;
+    until then every UID of the feed counts as changed.
+    """
+    body_hash = get_body_hash(content)
+    calendar = get_calendar(conn, url)
+    if calendar and calendar["body_hash"] == body_hash:
+        return None
+    # No hash means the last sync stopped before its changes were expanded.
+    expand_all = calendar is None or calendar["body_hash"] is None
+
+    ical = Calendar.from_ical(content)
+    timezones = b""
+    if "X-WR-TIMEZONE" in ical:
+        timezones += b"X-WR-TIMEZONE:" + str(ical["X-WR-TIMEZONE"]).encode() + b"\r\n"
+    timezones += b"".join(c.to_ical() for c in ical.walk("VTIMEZONE"))
+
+    stored = {
+        (row["uid"], row["recurrence_id"]): row["version"]
+        for row in conn.execute("SELECT uid, recurrence_id, version FROM components WHERE url = ?", (url,))
+    }
+    seen = set()
+    changed_uids = set()
+    updates = []
+    for component in ical.walk("VEVENT"):
+        uid = str(component.get("UID", ""))
+        recurrence_id = component["RECURRENCE-ID"].to_ical().decode() if "RECURRENCE-ID" in component else ""
+        key = (uid, recurrence_id)
+        seen.add(key)
+        version = get_component_version(component)
+        if expand_all:
+            changed_uids.add(uid)
+        if stored.get(key) != version:
+            changed_uids.add(uid)
+            updates.append((url, uid, recurrence_id, version, "RRULE" in component, component.to_ical()))
+    removed = set(stored) - seen
+    changed_uids.update(uid for uid, _ in removed)
+
+    with conn:
+        conn.execute(
+            "INSERT INTO calendars (url, body_hash, timezones) VALUES (?, NULL, ?) "
+            "ON CONFLICT (url) DO UPDATE SET body_hash = NULL, timezones = excluded.timezones",
+            (url, timezones)
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO components (url, uid, recurrence_id, version, recurring, ical) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            updates
+        )
+        conn.executemany(
+            "DELETE FROM components WHERE url = ? AND uid = ? AND recurrence_id = ?",
+            [(url, uid, recurrence_id) for uid, recurrence_id in removed]
+        )
+    logger.info("Calendar %s: %s components updated, %s removed", url, len(updates), len(removed))
+    return changed_uids
+
+
+def get_uids(conn: sqlite3.Connection, url: str, recurring: bool) -> Set[str]:
+    # A UID counts as recurring if any of its components (master or override) has a rule.
+    rows = conn.execute(
+        "SELECT uid FROM components WHERE url = ? GROUP BY uid HAVING MAX(recurring) = ?",
+        (url, int(recurring))
+    )
+    return {row["uid"] for row in rows}
+
+
+def expand_events(conn: sqlite3.Connection, url: str, uids: Iterable[str], start: datetime, end: datetime,
+                  current_timezone: ZoneInfo):
+    """Replace the stored occurrences of the given UIDs with those between start and end."""
+    uids = list(uids)
+    if not uids:
+        return
+    calendar = get_calendar(conn, url)
+    components = []
+    for i in range(0, len(uids), 500):
+        batch = uids[i:i + 500]
+        components.extend(row["ical"] for row in conn.execute(
+            f"SELECT ical FROM components WHERE url = ? AND uid IN ({','.join('?' * len(batch))})",
+            [url] + batch
+        ))
+
+    event_list = []
+    if components:
+        # Master events and their overrides share a UID, so each expansion sees them together.
+        content = b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n" + calendar["timezones"] + \
+            b"".join(components) + b"END:VCALENDAR\r\n"
+        event_list = events(string_content=content, start=start, end=end)
+
+    rows = []
+    for event in event_list:
+        localize_event(event, current_timezone)
+        rows.append((url, str(event.uid), event.start.timestamp(), event.end.timestamp(), event.all_day,
+                     event.summary, event.description, event.location))
+    with conn:
+        conn.executemany("DELETE FROM occurrences WHERE url = ? AND uid = ?", [(url, uid) for uid in uids])
+        conn.executemany(
+            "INSERT INTO occurrences (url, uid, start, end, all_day, summary, description, location) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+
+def count_events(conn: sqlite3.Connection, url: str, now: datetime) -> int:
+    return conn.execute(
+        "SELECT COUNT(*) FROM occurrences JOIN calendars USING (url) "
+        "WHERE url = ? AND end > ? AND start < expanded_until",
+        (url, now.timestamp())
+    ).fetchone()[0]
+
+
+def query_events(conn: sqlite3.Connection, urls: List[str], now: datetime, max_number: int,
+                 current_timezone: ZoneInfo) -> List[Event]:
+    rows = conn.execute(
+        "SELECT occurrences.* FROM occurrences JOIN calendars USING (url) "
+        f"WHERE url IN ({','.join('?' * len(urls))}) AND end > ? AND start < expanded_until "
+        "ORDER BY start LIMIT ?",
+        list(urls) + [now.timestamp(), max_number]
+    )
+    event_list = []
+    for row in rows:
+        event = Event()
+        event.uid = row["uid"]
+        event.start = datetime.fromtimestamp(row["start"], current_timezone)
+        event.end = datetime.fromtimestamp(row["end"], current_timezone)
+        event.all_day = bool(row["all_day"])
+        event.summary = row["summary"]
+        event.description = row["description"]
+        event.location = row["location"]
+        event_list.append(event)
+    return event_list
+
+
+def localize_event(event: Event, current_timezone: ZoneInfo):
+    if event.start.tzinfo is None or event.start.tzinfo.utcoffset(event.start) is None:
+        event.start = event.start.replace(tzinfo=timezone.utc)
+    if event.all_day:
+        event.start = event.start.replace(tzinfo=current_timezone)
+        event.end = event.end.replace(tzinfo=current_timezone)
+    event.start = event.start.astimezone(current_timezone)
+    event.end = event.end.astimezone(current_timezone)
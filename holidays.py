@@ -1,22 +1,52 @@
+import logging
 from datetime import date
-from typing import Optional
-
-import requests
+from typing import Dict, Optional
 
+import httpClient
+import settings
+from cache import read_json, write_json
 from settings import PROVINCE
 
+logger = logging.getLogger('app')
+
 HOLIDDAY_API_URL = "https://canada-holidays.ca/api/v1"
+HOLIDAY_TIMEOUT = 5
+
+# Holidays by date, per year, loaded at most once per process.
+_holiday_tables: Dict[int, Dict[str, str]] = {}
+
+
+def get_holidays(year: int):
+    response = httpClient.get(
+        f"{getattr(settings, 'HOLIDAY_API_URL', HOLIDDAY_API_URL)}/provinces/{PROVINCE}",
+        params={"optional": "true", "year": year},
+        timeout=HOLIDAY_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()["province"]["holidays"]
+
 
+def get_holiday_table(year: int, fetch: bool = True) -> Dict[str, str]:
+    if year in _holiday_tables:
+        return _holiday_tables[year]
 
-def get_holidays():
-    response = requests.get(f"{HOLIDDAY_API_URL}/provinces/{PROVINCE}?optional=true").json()
-    return response["province"]["holidays"]
+    cache_name = f"holidays-{year}-{PROVINCE}.json"
+    table = read_json(cache_name)
+    if table is None:
+        if not fetch:
+            return {}
+        logger.info("Fetching %s holidays for %s", year, PROVINCE)
+        try:
+            holidays = get_holidays(year)
+        except Exception:
+            logger.exception("Failed to fetch holidays")
+            return {}
+        table = {holiday["observedDate"]: holiday.get("nameEn") for holiday in holidays}
+        write_json(cache_name, table)
+    _holiday_tables[year] = table
+    return table
 
 
-def get_todays_holiday() -> Optional[str]:
+def get_todays_holiday(fetch: bool = True) -> Optional[str]:
     today = date.today()
-    holidays = get_holidays()
-    for holiday in holidays:
-        if holiday["observedDate"] == today.strftime("%Y-%m-%d"):
-            return holiday.get("nameEn")
-    return None
+    return get_holiday_table(today.year, fetch).get(today.isoformat())
@@ -0,0 +1,94 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('app')
+
+DEFAULT_TIMEOUT = 10
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_JITTER = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# PROPFIND and REPORT only read, so they are as safe to retry as GET.
+RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PROPFIND", "REPORT"})
+POOL_CONNECTIONS = 8
+POOL_MAXSIZE = 8
+
+
+@dataclass
+class RequestMetric:
+    method: str
+    host: str
+    status: Optional[int]
+    seconds: float
+    size: int
+
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_metrics: List[RequestMetric] = []
+
+
+def get_session() -> requests.Session:
+    # One session for every data source, so hosts shared between them
+    # (and repeated requests to one host) reuse TLS connections.
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=MAX_RETRIES,
+                backoff_factor=RETRY_BACKOFF,
+                backoff_jitter=RETRY_JITTER,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=RETRY_METHODS,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def request(method: str, url: str, timeout: float = DEFAULT_TIMEOUT, **kwargs) -> requests.Response:
+    start = time.monotonic()
+    status = None
+    size = 0
+    try:
+        response = get_session().request(method, url, timeout=timeout, **kwargs)
+        status = response.status_code
+        size = len(response.content)
+        return response
+    finally:
+        metric = RequestMetric(method, urlparse(url).netloc, status, time.monotonic() - start, size)
+        with _session_lock:
+            _metrics.append(metric)
+        logger.debug("%s %s -> %s in %.2fs (%s bytes)", method, metric.host, status, metric.seconds, size)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def get_metrics() -> List[RequestMetric]:
+    with _session_lock:
+        return list(_metrics)
+
+
+def log_metrics():
+    metrics = get_metrics()
+    if not metrics:
+        return
+    for metric in metrics:
+        logger.info("%s %s -> %s in %.2fs (%s bytes)",
+                    metric.method, metric.host, metric.status, metric.seconds, metric.size)
+    logger.info("%s requests, %.2fs in total", len(metrics), sum(metric.seconds for metric in metrics))
@@ -29,6 +29,7 @@
 
 
 import logging
+from . import epdbuffer
 from . import epdconfig
 
 # Display resolution
@@ -156,27 +157,10 @@ class EPD:
 
 
     def getbuffer(self, image):
-        # logger.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width / 8) * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        # logger.debug("imwidth = %d, imheight = %d",imwidth,imheight)
-        if imwidth == self.width and imheight == self.height:
-            logger.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        elif imwidth == self.height and imheight == self.width:
-            logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        buf[int((newx + newy * self.width) / 8)] &= ~(0x80 >> (y % 8))
+        buf = epdbuffer.getbuffer_mono(image, self.width, self.height)
+        if buf is None:
+            # return a blank buffer
+            return [0xFF] * (int((self.width + 7) / 8) * self.height)
         return buf
 
     def Clear(self):
@@ -209,7 +193,7 @@ class EPD:
         if (ryimage != None):
             for j in range(Height):
                 for i in range(Width):
-                    ryimage[i + j * Width] = ~ryimage[i + j * Width]
+                    ryimage[i + j * Width] = ~ryimage[i + j * Width] & 0xFF
             self.send_command(0x26)
             self.send_data2(ryimage)
 
@@ -227,7 +211,7 @@ class EPD:
         if (ryimage != None):
             for j in range(Height):
                 for i in range(Width):
-                    ryimage[i + j * Width] = ~ryimage[i + j * Width]
+                    ryimage[i + j * Width] = ~ryimage[i + j * Width] & 0xFF
             self.send_command(0x26)
             self.send_data2(ryimage)
 
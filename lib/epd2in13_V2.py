@@ -29,6 +29,9 @@
 
 
 import logging
+from PIL import Image
+
+from . import epdbuffer
 from . import epdconfig
 
 # Display resolution
@@ -219,33 +222,18 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        if self.width%8 == 0:
-            linewidth = int(self.width/8)
-        else:
-            linewidth = int(self.width/8) + 1
-         
-        buf = [0xFF] * (linewidth * self.height)
         image_monocolor = image.convert('1')
         imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        
         if(imwidth == self.width and imheight == self.height):
             logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):                    
-                    if pixels[x, y] == 0:
-                        x = imwidth - x
-                        buf[int(x / 8) + y * linewidth] &= ~(0x80 >> (x % 8))
+            # Mirrored, with pixel x landing on bit imwidth - x
+            mirrored = Image.new('1', (imwidth + 1, imheight), 1)
+            mirrored.paste(image_monocolor.transpose(Image.FLIP_LEFT_RIGHT), (1, 0))
+            return epdbuffer.pack_mono(mirrored)
         elif(imwidth == self.height and imheight == self.width):
             logger.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        newy = imwidth - newy - 1
-                        buf[int(newx / 8) + newy*linewidth] &= ~(0x80 >> (y % 8))
-        return buf   
+            return epdbuffer.pack_mono(image_monocolor.transpose(Image.TRANSPOSE))
+        return [0xFF] * (int((self.width + 7) / 8) * self.height)
         
         
     def display(self, image):
@@ -29,10 +29,10 @@
 #
 
 import logging
+from . import epdbuffer
 from . import epdconfig
 
 import PIL
-from PIL import Image
 import io
 
 # Display resolution
@@ -159,30 +159,15 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        # Create a pallette with the 4 colors supported by the panel
-        pal_image = Image.new("P", (1,1))
-        pal_image.putpalette( (0,0,0,  255,255,255,  255,255,0,   255,0,0) + (0,0,0)*252)
-
-        # Check if we need to rotate the image
-        imwidth, imheight = image.size
-        if(imwidth == self.width and imheight == self.height):
-            image_temp = image
-        elif(imwidth == self.height and imheight == self.width):
-            image_temp = image.rotate(90, expand=True)
-        else:
-            logger.warning("Invalid image dimensions: %d x %d, expected %d x %d" % (imwidth, imheight, self.width, self.height))
-
-        # Convert the soruce image to the 4 colors, dithering if needed
-        image_4color = image_temp.convert("RGB").quantize(palette=pal_image)
-        buf_4color = bytearray(image_4color.tobytes('raw'))
-
-        # into a single byte to transfer to the panel
-        buf = [0x00] * int(self.width * self.height / 4)
-        idx = 0
-        for i in range(0, len(buf_4color), 4):
-            buf[idx] = (buf_4color[i] << 6) + (buf_4color[i+1] << 4) + (buf_4color[i+2] << 2) + buf_4color[i+3]
-            idx += 1
-
+        # The 4 colors supported by the panel, in the order it numbers them
+        palette = (0,0,0,  255,255,255,  255,255,0,   255,0,0)
+
+        # Convert the source image to the 4 colors, dithering if needed, and pack
+        # four pixels into each byte to transfer to the panel
+        buf = epdbuffer.getbuffer_palette(image, self.width, self.height, palette, 2)
+        if buf is None:
+            # return a blank buffer
+            return [0x55] * (int((self.width + 3) / 4) * self.height)
         return buf
 
     def display(self, image):
@@ -29,6 +29,7 @@
 
 
 import logging
+from . import epdbuffer
 from . import epdconfig
 
 # Display resolution
@@ -371,63 +372,17 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        # logger.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width / 8) * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        # logger.debug("imwidth = %d, imheight = %d",imwidth,imheight)
-        if imwidth == self.width and imheight == self.height:
-            logger.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        elif imwidth == self.height and imheight == self.width:
-            logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        buf[int((newx + newy * self.width) / 8)] &= ~(0x80 >> (y % 8))
+        buf = epdbuffer.getbuffer_mono(image, self.width, self.height)
+        if buf is None:
+            # return a blank buffer
+            return [0xFF] * (int((self.width + 7) / 8) * self.height)
         return buf
     
     def getbuffer_4Gray(self, image):
-        # logger.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width / 4) * self.height)
-        image_monocolor = image.convert('L')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        i=0
-        # logger.debug("imwidth = %d, imheight = %d",imwidth,imheight)
-        if(imwidth == self.width and imheight == self.height):
-            logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((x + (y * self.width))/4)] = ((pixels[x-3, y]&0xc0) | (pixels[x-2, y]&0xc0)>>2 | (pixels[x-1, y]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6)
-                        
-        elif(imwidth == self.height and imheight == self.width):
-            logger.debug("Horizontal")
-            for x in range(imwidth):
-                for y in range(imheight):
-                    newx = y
-                    newy = self.height - x - 1
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((newx + (newy * self.width))/4)] = ((pixels[x, y-3]&0xc0) | (pixels[x, y-2]&0xc0)>>2 | (pixels[x, y-1]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6) 
+        buf = epdbuffer.getbuffer_gray4(image, self.width, self.height)
+        if buf is None:
+            # return a blank buffer
+            return [0xFF] * (int(self.width / 4) * self.height)
         return buf
 
     def display(self, imageblack):
@@ -563,89 +518,21 @@ class EPD:
         Width =int(self.width / 16)+1
         Width1 =int(self.width / 8)
 
+        # Each controller drives one half of the panel; the halves share a column of bytes.
+        high, low = epdbuffer.gray4_planes(image)
         self.send_command(0x24)
-        for j in range(self.height):   
-            for i in range(Width):
-                temp3=0
-                for o in range(0, 2):
-                    temp1 = image[(j * Width1 + i)*2+o]
-                    for k in range(0, 4):
-                        temp2 = temp1&0xC0 
-                        if(temp2 == 0xC0):
-                            temp3 |= 0x01
-                        elif(temp2 == 0x00):
-                            temp3 |= 0x00  
-                        elif(temp2 == 0x80): 
-                            temp3 |= 0x00 
-                        else: #0x40
-                            temp3 |= 0x01 
-                        if(o!=1 or k!=3):
-                            temp3 <<= 1
-                        temp1 <<= 2
-                self.send_data(temp3)
-            
-        self.send_command(0x26)	       
-        for j in range(self.height):   
-            for i in range(Width):
-                temp3=0
-                for o in range(0, 2):
-                    temp1 = image[(j * Width1 + i)*2+o]
-                    for k in range(0, 4):
-                        temp2 = temp1&0xC0 
-                        if(temp2 == 0xC0):
-                            temp3 |= 0x01
-                        elif(temp2 == 0x00):
-                            temp3 |= 0x00  
-                        elif(temp2 == 0x80): 
-                            temp3 |= 0x01 
-                        else: #0x40
-                            temp3 |= 0x00 
-                        if(o!=1 or k!=3):
-                            temp3 <<= 1
-                        temp1 <<= 2
-                self.send_data(temp3)
+        for i in range(self.height):
+            self.send_data2(low[i * Width1 : i * Width1 + Width])
+        self.send_command(0x26)
+        for i in range(self.height):
+            self.send_data2(high[i * Width1 : i * Width1 + Width])
 
         self.send_command(0xA4)
-        for j in range(self.height):   
-            for i in range(Width):
-                temp3=0
-                for o in range(0, 2):
-                    temp1 = image[(j * Width1 + i + Width - 1)*2+o]
-                    for k in range(0, 4):
-                        temp2 = temp1&0xC0 
-                        if(temp2 == 0xC0):
-                            temp3 |= 0x01
-                        elif(temp2 == 0x00):
-                            temp3 |= 0x00  
-                        elif(temp2 == 0x80): 
-                            temp3 |= 0x00 
-                        else: #0x40
-                            temp3 |= 0x01 
-                        if(o!=1 or k!=3):
-                            temp3 <<= 1
-                        temp1 <<= 2
-                self.send_data(temp3)
-            
-        self.send_command(0xA6)	       
-        for j in range(self.height):   
-            for i in range(Width):
-                temp3=0
-                for o in range(0, 2):
-                    temp1 = image[(j * Width1 + i + Width - 1)*2+o]
-                    for k in range(0, 4):
-                        temp2 = temp1&0xC0 
-                        if(temp2 == 0xC0):
-                            temp3 |= 0x01
-                        elif(temp2 == 0x00):
-                            temp3 |= 0x00  
-                        elif(temp2 == 0x80): 
-                            temp3 |= 0x01 
-                        else: #0x40
-                            temp3 |= 0x00 
-                        if(o!=1 or k!=3):
-                            temp3 <<= 1
-                        temp1 <<= 2
-                self.send_data(temp3)
+        for i in range(self.height):
+            self.send_data2(low[i * Width1 + Width - 1 : i * Width1 + Width * 2 - 1])
+        self.send_command(0xA6)
+        for i in range(self.height):
+            self.send_data2(high[i * Width1 + Width - 1 : i * Width1 + Width * 2 - 1])
         
         self.TurnOnDisplay_4GRAY()
 
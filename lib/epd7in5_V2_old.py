@@ -29,6 +29,7 @@
 
 
 import logging
+from . import epdbuffer
 from . import epdconfig
 
 # Display resolution
@@ -425,37 +426,18 @@ class EPD:
     
 
     def getbuffer(self, image):
-        img = image
-        imwidth, imheight = img.size
-        if(imwidth == self.width and imheight == self.height):
-            img = img.convert('1')
-        elif(imwidth == self.height and imheight == self.width):
-            # image has correct dimensions, but needs to be rotated
-            img = img.rotate(90, expand=True).convert('1')
-        else:
-            logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
-            # return a blank buffer
-            return [0x00] * (int(self.width/8) * self.height)
-
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
         # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
+        buf = epdbuffer.getbuffer_mono(image, self.width, self.height, invert=True, rotate_first=True)
+        if buf is None:
+            # return a blank buffer
+            return [0x00] * (int(self.width/8) * self.height)
         return buf
 
     def display(self, image):
-        if(self.width % 8 == 0):
-            Width = self.width // 8
-        else:
-            Width = self.width // 8 +1
-        Height = self.height
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~image[i + j * Width]
+        # The old-data plane is the complement of the new one.
         self.send_command(0x10)
-        self.send_data2(image1)
+        self.send_data2(epdbuffer.invert(image))
 
         self.send_command(0x13)
         self.send_data2(image)
@@ -466,9 +448,9 @@ class EPD:
 
     def Clear(self):
         self.send_command(0x10)
-        self.send_data2([0xFF] * int(self.width * self.height / 8))
+        self.send_data2(epdbuffer.plane(0xFF, int(self.width * self.height / 8)))
         self.send_command(0x13)
-        self.send_data2([0x00] * int(self.width * self.height / 8))
+        self.send_data2(epdbuffer.plane(0x00, int(self.width * self.height / 8)))
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
@@ -506,10 +488,9 @@ class EPD:
         self.send_data ((Yend-1)%256)  #y-end
         self.send_data (0x01)
 
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~Image[i + j * Width]
+        # The window, complemented, then white up to a whole frame.
+        image1 = epdbuffer.invert(Image[:Width * Height])
+        image1 += epdbuffer.plane(0xFF, int(self.width * self.height / 8) - len(image1))
 
         self.send_command(0x13)   #Write Black and White image to RAM
         self.send_data2(image1)
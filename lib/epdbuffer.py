@@ -0,0 +1,158 @@
+# *****************************************************************************
+# * | File        :	  epdbuffer.py
+# * | Function    :   Frame buffer packing shared by the drivers
+# * | Info        :   Bulk replacements for the per-pixel loops in getbuffer
+# -----------------------------------------------------------------------------
+
+import logging
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Translation table flipping every bit of a byte, for bytes.translate.
+INVERT = bytes(0xFF - i for i in range(256))
+
+# 2-bit code for every grey level: its top two bits, except that 0xC0 and 0x80
+# are taken one shade darker, which is how getbuffer_4Gray always mapped them.
+# 3 is white, 2 and 1 the light and dark greys, 0 black.
+GRAY4_CODES = np.arange(256, dtype=np.uint8) >> 6
+GRAY4_CODES[0xC0] = 2
+GRAY4_CODES[0x80] = 1
+
+
+def invert(buf):
+    """Return buf with every bit flipped, as bytes."""
+    return bytes(buf).translate(INVERT)
+
+
+@lru_cache(maxsize=16)
+def plane(value, size):
+    """Return size bytes of value; the same object is handed out for repeated calls."""
+    return bytes([value]) * size
+
+
+def pack_mono(image, invert=False):
+    """Pack a 1-bit image row by row, 8 pixels per byte with the leftmost in the top bit.
+
+    Set bits are white (black when inverted). Rows whose width is not a
+    multiple of 8 are padded to whole bytes with white pixels.
+    """
+    if image.mode != '1':
+        image = image.convert('1')
+    width, height = image.size
+    if width % 8:
+        padded = Image.new('1', (-(-width // 8) * 8, height), 1)
+        padded.paste(image, (0, 0))
+        image = padded
+    buf = image.tobytes('raw')
+    if invert:
+        buf = buf.translate(INVERT)
+    return bytearray(buf)
+
+
+def getbuffer_mono(image, width, height, invert=False, rotate_first=False):
+    """Pack image for a width x height 1-bit panel, or return None if it does not fit.
+
+    An image of height x width is turned 90° counter-clockwise first, which is
+    what the per-pixel loops this replaces did. By default it is converted to
+    1-bit before turning; rotate_first turns it before converting, which
+    dithers grey pixels differently.
+    """
+    if image.size == (width, height):
+        image = image.convert('1')
+    elif image.size == (height, width):
+        if rotate_first:
+            image = image.rotate(90, expand=True).convert('1')
+        else:
+            image = image.convert('1').rotate(90, expand=True)
+    else:
+        logger.warning("Wrong image dimensions: must be " + str(width) + "x" + str(height))
+        return None
+    return pack_mono(image, invert)
+
+
+def getbuffer_gray4(image, width, height, transpose=False):
+    """Pack image for a width x height 4-grey panel, or return None if it does not fit.
+
+    Pixels go 4 per byte with the leftmost in the top two bits. An image of
+    height x width is turned 90° counter-clockwise first, or flipped along its
+    diagonal with transpose, as the drivers' loops did.
+    """
+    image = image.convert('L')
+    if image.size == (width, height):
+        pixels = np.asarray(image)
+    elif image.size == (height, width):
+        pixels = np.asarray(image).T if transpose else np.rot90(np.asarray(image))
+    else:
+        logger.warning("Wrong image dimensions: must be " + str(width) + "x" + str(height))
+        return None
+    codes = GRAY4_CODES[pixels]
+    if width % 4:
+        codes = np.pad(codes, ((0, 0), (0, -width % 4)), constant_values=3)
+    packed = codes[:, 0::4] << 6 | codes[:, 1::4] << 4 | codes[:, 2::4] << 2 | codes[:, 3::4]
+    return bytearray(packed.tobytes())
+
+
+def gray4_planes(buf, invert=False):
+    """Split a getbuffer_gray4 buffer into the two 1-bit planes the controllers take.
+
+    Returns the plane of high bits and the plane of low bits of every pixel's
+    code, as bytes, each flipped when invert is set.
+    """
+    bits = np.unpackbits(np.frombuffer(bytes(buf), dtype=np.uint8))
+    high = np.packbits(bits[0::2]).tobytes()
+    low = np.packbits(bits[1::2]).tobytes()
+    if invert:
+        return high.translate(INVERT), low.translate(INVERT)
+    return high, low
+
+
+@lru_cache(maxsize=8)
+def palette_image(palette):
+    """Return a "P" image carrying palette, padded with black, for Image.quantize."""
+    pal_image = Image.new("P", (1, 1))
+    pal_image.putpalette(palette + (0, 0, 0) * (256 - len(palette) // 3))
+    return pal_image
+
+
+def palette_indices(image, palette):
+    """Return the index into palette of every pixel, 0 for those not exactly a palette colour."""
+    rgb = np.asarray(image.convert("RGB")).astype(np.uint32)
+    keys = rgb[..., 0] << 16 | rgb[..., 1] << 8 | rgb[..., 2]
+    indices = np.zeros(keys.shape, dtype=np.uint8)
+    # Backwards, so a colour listed twice keeps its first index.
+    for index in reversed(range(len(palette) // 3)):
+        r, g, b = palette[index * 3:index * 3 + 3]
+        indices[keys == (r << 16 | g << 8 | b)] = index
+    return indices
+
+
+def getbuffer_palette(image, width, height, palette, bits, dither=True):
+    """Quantize image to palette and pack it for a width x height colour panel.
+
+    palette is a flat (r, g, b, ...) tuple whose indices the panel takes as
+    colours. image is dithered to it, or without dither only pixels of exactly
+    a palette colour keep it and the rest get index 0. The indices go
+    8 // bits per byte with the leftmost in the top bits, each row padded to
+    whole bytes with index 0. An image of height x width is turned 90°
+    counter-clockwise first. Returns None if the image fits neither way.
+    """
+    if image.size != (width, height):
+        if image.size != (height, width):
+            logger.warning("Invalid image dimensions: %d x %d, expected %d x %d" % (image.size + (width, height)))
+            return None
+        image = image.rotate(90, expand=True)
+    if dither:
+        indices = np.asarray(image.convert("RGB").quantize(palette=palette_image(palette)))
+    else:
+        indices = palette_indices(image, palette)
+    per_byte = 8 // bits
+    if width % per_byte:
+        indices = np.pad(indices, ((0, 0), (0, -width % per_byte)))
+    packed = np.zeros((height, indices.shape[1] // per_byte), dtype=np.uint8)
+    for i in range(per_byte):
+        packed |= indices[:, i::per_byte] << (8 - bits * (i + 1))
+    return bytearray(packed.tobytes())
@@ -1,12 +1,16 @@
 import logging
 import os
+import threading
+import time
 from dataclasses import dataclass
+from typing import Optional
 
-import requests
 from PIL import Image
 from PIL.Image import Image as TImage
 
-from settings import OPENWEATHERMAP_API_KEY, WEATHER_CITY
+import httpClient
+import settings
+from cache import read_json, write_json
 
 logger = logging.getLogger('app')
 
@@ -15,6 +19,11 @@ WEATHER_PICTURES_PATH = os.path.join(CURRENT_PATH, 'pictures', 'weather')
 
 BASE_URL = "https://api.openweathermap.org"
 CITY_LIMIT = 5
+GEOCODE_CACHE_NAME = "geocode.json"
+WEATHER_CACHE_NAME = "weather.json"
+WEATHER_CACHE_TTL = 30 * 60
+WEATHER_MAX_STALE = 24 * 60 * 60
+WEATHER_REFRESH_BUDGET = 5
 
 
 @dataclass
@@ -26,20 +35,37 @@ class Weather:
     weather: str
     weather_desc: str
     weather_icon: Image
+    icon: str
     rain: str
     snow: str
     clouds: int
 
 
+def get_base_url() -> str:
+    return getattr(settings, "OPENWEATHERMAP_URL", BASE_URL)
+
+
 def get_lat_long():
+    # The city never moves, so coordinates come from settings or the
+    # geocoding cache and the API is only asked once per WEATHER_CITY.
+    if getattr(settings, "WEATHER_LAT", None) is not None and getattr(settings, "WEATHER_LON", None) is not None:
+        return settings.WEATHER_LAT, settings.WEATHER_LON
+    geocode_cache = read_json(GEOCODE_CACHE_NAME) or {}
+    if settings.WEATHER_CITY in geocode_cache:
+        return tuple(geocode_cache[settings.WEATHER_CITY])
+
     logger.info("Fetching weather geolocation")
-    geo_url = f"{BASE_URL}/geo/1.0/direct?q={WEATHER_CITY}&limit={CITY_LIMIT}&appid={OPENWEATHERMAP_API_KEY}"
+    geo_url = f"{get_base_url()}/geo/1.0/direct?q={settings.WEATHER_CITY}&limit={CITY_LIMIT}&appid={settings.OPENWEATHERMAP_API_KEY}"
     try:
-        data = requests.get(geo_url, timeout=10).json()
-        return data[0].get("lat"), data[0].get("lon")
+        data = httpClient.get(geo_url).json()
+        lat, lon = data[0].get("lat"), data[0].get("lon")
     except Exception as e:
         logger.error("Failed to fetch city location", e)
         return None, None
+    if lat is not None and lon is not None:
+        geocode_cache[settings.WEATHER_CITY] = [lat, lon]
+        write_json(GEOCODE_CACHE_NAME, geocode_cache)
+    return lat, lon
 
 
 def get_weather_icon(icon: str) -> TImage:
@@ -56,30 +82,92 @@ def get_snow_string(snow: float) -> str:
         return f"{round(snow)}cm"
 
 
+def fetch_weather_data(lat: float, lon: float) -> dict:
+    weather_url = f"{get_base_url()}/data/3.0/onecall?lat={lat}&lon={lon}&exclude=minutely,hourly,alerts&units=metric&appid={settings.OPENWEATHERMAP_API_KEY}"
+    response = httpClient.get(weather_url)
+    response.raise_for_status()
+    data = response.json()
+    write_json(WEATHER_CACHE_NAME, {"lat": lat, "lon": lon, "fetched": time.time(), "data": data})
+    return data
+
+
+def refresh_weather_data(lat: float, lon: float, budget: float) -> Optional[dict]:
+    # Rendering does not wait for the refresh beyond the budget. It goes on in
+    # the background while the frame is drawn and still fills the cache if it
+    # finishes before the process exits, but nothing waits for it at exit.
+    result = {}
+
+    def refresh():
+        try:
+            result["data"] = fetch_weather_data(lat, lon)
+        except Exception:
+            logger.exception("Failed to fetch weather")
+
+    thread = threading.Thread(target=refresh, name="weather-refresh", daemon=True)
+    thread.start()
+    thread.join(timeout=budget)
+    return result.get("data")
+
+
+def parse_weather(data: dict) -> Weather:
+    current = data["current"]
+    today = data["daily"][0]
+    return Weather(
+        temp=round(current["temp"]),
+        feels_like=round(current["feels_like"]),
+        temp_min=round(today["temp"]["min"]),
+        temp_max=round(today["temp"]["max"]),
+        weather=today["weather"][0]["main"],
+        weather_desc=today["weather"][0]["description"].title(),
+        weather_icon=get_weather_icon(today["weather"][0]["icon"][:2]),
+        icon=today["weather"][0]["icon"][:2],
+        rain=round(today.get('rain', 0)),
+        snow=get_snow_string(today.get("snow")),
+        clouds=today["clouds"]
+    )
+
+
+def get_cached_weather() -> Optional[Weather]:
+    cached = read_json(WEATHER_CACHE_NAME)
+    if not cached or time.time() - cached["fetched"] >= getattr(settings, "WEATHER_MAX_STALE", WEATHER_MAX_STALE):
+        return None
+    try:
+        return parse_weather(cached["data"])
+    except Exception:
+        logger.exception("Failed to parse weather")
+        return None
+
+
 def get_weather():
     logger.info("Fetching weather data")
     lat, lon = get_lat_long()
     if not lat or not lon:
         return None
-    weather_url = f"{BASE_URL}/data/3.0/onecall?lat={lat}&lon={lon}&exclude=minutely,hourly,alerts&units=metric&appid={OPENWEATHERMAP_API_KEY}"
+
+    cached = read_json(WEATHER_CACHE_NAME)
+    if cached and (cached.get("lat"), cached.get("lon")) != (lat, lon):
+        cached = None
+    age = time.time() - cached["fetched"] if cached else None
+    ttl = getattr(settings, "WEATHER_CACHE_TTL", WEATHER_CACHE_TTL)
+    max_stale = getattr(settings, "WEATHER_MAX_STALE", WEATHER_MAX_STALE)
+
+    if age is not None and age < ttl:
+        logger.info("Using cached weather from %d minutes ago", age // 60)
+        data = cached["data"]
+    elif age is not None and age < max_stale:
+        data = refresh_weather_data(lat, lon, getattr(settings, "WEATHER_REFRESH_BUDGET", WEATHER_REFRESH_BUDGET))
+        if data is None:
+            logger.warning("Using stale weather from %d minutes ago", age // 60)
+            data = cached["data"]
+    else:
+        try:
+            data = fetch_weather_data(lat, lon)
+        except Exception:
+            logger.exception("Failed to fetch weather")
+            return None
+
     try:
-        data = requests.get(weather_url, timeout=10).json()
-
-        current = data["current"]
-        today = data["daily"][0]
-        weather = Weather(
-            temp=round(current["temp"]),
-            feels_like=round(current["feels_like"]),
-            temp_min=round(today["temp"]["min"]),
-            temp_max=round(today["temp"]["max"]),
-            weather=today["weather"][0]["main"],
-            weather_desc=today["weather"][0]["description"].title(),
-            weather_icon=get_weather_icon(today["weather"][0]["icon"][:2]),
-            rain=round(today.get('rain', 0)),
-            snow=get_snow_string(today.get("snow")),
-            clouds=today["clouds"]
-        )
-        return weather
+        return parse_weather(data)
     except Exception:
-        logger.exception("Failed to fetch weather")
+        logger.exception("Failed to parse weather")
         return None